@@ -1,14 +1,11 @@
 import streamlit as st
 import pandas as pd
-import psycopg2
 from datetime import datetime
 import base64
-import os
-from dotenv import load_dotenv
 import streamlit.components.v1 as components
 
-# Load environment variables from .env
-load_dotenv(".env")
+import db
+from warmup import warm_up
 
 # Set page configuration
 st.set_page_config(
@@ -17,19 +14,16 @@ st.set_page_config(
     page_icon="💊",
 )
 
-# Retrieve the DATABASE_URL from the environment
-DATABASE_URL = os.environ.get("db_url")
 # Check if the database URL is set
-if DATABASE_URL is None:
+if db.DATABASE_URL is None:
     st.error("DATABASE_URL environment variable is not set.")
-
-conn = psycopg2.connect(DATABASE_URL)
-
-# Check if the database URL is set
-if DATABASE_URL is None:
-    st.error("DATABASE_URL environment variable is not set.")
-
-conn = psycopg2.connect(DATABASE_URL)
+else:
+    # Preload the caches once per server process. Without the database the page
+    # still shows what it can, its own lookups report the error
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
 
 # Welcome message
 st.write("# Welcome to PGxAnalyzer")
@@ -105,9 +99,9 @@ if st.button("Sample Output"):
     # Display the heading outside the loop
     st.write("**Queries with Strong Classification:**")
 
+    # Lookups answered from their last known good result while the database was down
+    fallbacks = []
 
-    # Connect to your PostgreSQL database (assuming you have a connection established)
-    cur = conn.cursor()
 
     # Execute the SQL query for each pair of genesymbol and diplotype
     for idx, pair in enumerate(pairs, start=1):
@@ -115,37 +109,10 @@ if st.button("Sample Output"):
         if len(pair) == 2:
             genesymbol, diplotype = pair
 
-            # Execute the custom SQL query
-            query = """
-                SELECT DISTINCT ON (p.drugid)
-                    dp.diplotype,
-                    r.activityscore,
-                    r.phenotypes,
-                    dp.ehrpriority,
-                    p.drugid,
-                    dr.name,
-                    r.population,
-                    r.drugrecommendation,
-                    r.classification
-                FROM cpic.gene_result_diplotype d
-                JOIN cpic.gene_result_lookup l ON d.functionphenotypeid = l.id
-                JOIN cpic.gene_result gr ON l.phenotypeid = gr.id
-                JOIN cpic.pair p ON gr.genesymbol = p.genesymbol
-                JOIN cpic.drug dr ON p.drugid = dr.drugid
-                JOIN cpic.recommendation r ON dr.drugid = r.drugid
-                JOIN cpic.diplotype_phenotype dp ON r.phenotypes @> dp.phenotype
-                WHERE dp.diplotype ->> %s = %s
-                    AND r.activityscore @> dp.activityscore
-                    AND r.classification <> 'No Recommendation'
-                    AND r.drugrecommendation <> 'No recommendation'
-                ORDER BY p.drugid, r.classification;
-            """
-
-            # Execute the query with parameters
-            cur.execute(query, (genesymbol, diplotype))
-
-            # Fetch the results
-            result_df = pd.DataFrame(cur.fetchall(), columns=["diplotype", "activityscore", "phenotypes", "ehrpriority", "drugid", "name", "population", "drugrecommendation", "classification"])
+            # Fetch the recommendations for the gene symbol and diplotype
+            with db.track_fallbacks() as pair_fallbacks:
+                result_df = db.fetch_pair_recommendations(genesymbol.strip(), diplotype.strip(), include_diplotype=True)
+            fallbacks += pair_fallbacks
 
             # Check if the DataFrame is not empty before processing
             if not result_df.empty:
@@ -171,8 +138,8 @@ if st.button("Sample Output"):
                 # Add a space after each result
                 html_report += "<br>\n"
 
-    # Close the database connection
-    conn.close()
+    if fallbacks:
+        st.warning(db.FALLBACK_WARNING)
 
     # Display the entire HTML report
     st.markdown(html_report, unsafe_allow_html=True)
@@ -0,0 +1,142 @@
+"""Websocket client for a running streamlit server, used by the load test.
+
+Speaks the protobuf messages of streamlit's frontend: page runs with widget
+values, file uploads and the reruns of auto-refreshing fragments.
+"""
+import time
+import uuid
+
+import requests
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.Common_pb2 import FileUploaderState
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from websockets.sync.client import connect
+
+
+class ServerSession:
+    # One browser tab: a websocket session with a running streamlit server, speaking
+    # the same protobuf messages as the frontend
+
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.websocket = connect(
+            base_url.replace("http", "ws", 1) + "/_stcore/stream",
+            subprotocols=["streamlit"],
+            max_size=None,
+            open_timeout=timeout,
+        )
+        self.session_id = None
+        self.pages = {}
+        self.page_script_hash = ""
+        self.widget_states = {}
+        self.elements = []
+        # Fragments that rerun on their own, with their interval in seconds
+        self.auto_rerun_fragments = {}
+
+    def close(self):
+        self.websocket.close()
+
+    def open_page(self, name):
+        # The first run opens the main page and lists the others
+        if not self.pages:
+            self.run()
+        self.page_script_hash = next(page_hash for page_name, page_hash in self.pages.items() if name in page_name)
+        self.widget_states = {}
+        return self.run()
+
+    def send(self, **fields):
+        back_msg = BackMsg(**fields)
+        self.websocket.send(back_msg.SerializeToString())
+
+    def run(self, triggers=(), fragment_id=""):
+        # Rerun the page with the current widget values, like the frontend after an interaction
+        back_msg = BackMsg()
+        rerun = back_msg.rerun_script
+        rerun.page_script_hash = self.page_script_hash
+        rerun.fragment_id = fragment_id
+        rerun.is_auto_rerun = bool(fragment_id)
+        for widget_id, (value_type, value) in self.widget_states.items():
+            state = rerun.widget_states.widgets.add(id=widget_id)
+            if value_type == "file_uploader_state_value":
+                state.file_uploader_state_value.CopyFrom(value)
+            else:
+                setattr(state, value_type, value)
+        for widget_id in triggers:
+            rerun.widget_states.widgets.add(id=widget_id, trigger_value=True)
+        self.websocket.send(back_msg.SerializeToString())
+        return self.receive_until_finished()
+
+    def receive(self, timeout):
+        forward_msg = ForwardMsg()
+        forward_msg.ParseFromString(self.websocket.recv(timeout=timeout))
+        return forward_msg
+
+    def receive_until_finished(self):
+        deadline = time.time() + self.timeout
+        while True:
+            forward_msg = self.receive(timeout=max(deadline - time.time(), 0.01))
+            msg_type = forward_msg.WhichOneof("type")
+            if msg_type == "new_session":
+                # Sent when a full run starts, fragment runs only add to the elements
+                self.session_id = forward_msg.new_session.initialize.session_id or self.session_id
+                self.elements = []
+                self.auto_rerun_fragments = {}
+            elif msg_type == "navigation":
+                self.pages = {page.page_name: page.page_script_hash for page in forward_msg.navigation.app_pages}
+            elif msg_type == "delta" and forward_msg.delta.WhichOneof("type") == "new_element":
+                self.elements.append(forward_msg.delta.new_element)
+            elif msg_type == "auto_rerun":
+                self.auto_rerun_fragments[forward_msg.auto_rerun.fragment_id] = forward_msg.auto_rerun.interval
+            elif msg_type == "script_finished":
+                status = ForwardMsg.ScriptFinishedStatus.Name(forward_msg.script_finished)
+                if status != "FINISHED_EARLY_FOR_RERUN":
+                    return status
+
+    def widgets(self, kind):
+        return [getattr(element, kind) for element in self.elements if element.WhichOneof("type") == kind]
+
+    def widget(self, kind, label):
+        return next(widget for widget in self.widgets(kind) if widget.label == label)
+
+    def select(self, label, option):
+        self.widget_states[self.widget("selectbox", label).id] = ("string_value", option)
+        return self.run()
+
+    def click(self, label):
+        return self.run(triggers=[self.widget("button", label).id])
+
+    def wait_for(self, kind, label):
+        # Rerun the auto-refreshing fragments like the browser until the widget shows up
+        deadline = time.time() + self.timeout
+        while not any(widget.label == label for widget in self.widgets(kind)):
+            if not self.auto_rerun_fragments or time.time() > deadline:
+                raise TimeoutError(f"{kind} {label!r} did not appear")
+            fragment_id, interval = next(iter(self.auto_rerun_fragments.items()))
+            time.sleep(interval)
+            self.run(fragment_id=fragment_id)
+
+    def upload(self, label, file_name, contents):
+        # Ask for an upload URL, upload the file over HTTP and hand its id to the widget
+        uploader = self.widget("file_uploader", label)
+        request_id = uuid.uuid4().hex
+        self.send(file_urls_request={"request_id": request_id, "file_names": [file_name], "session_id": self.session_id})
+        while True:
+            forward_msg = self.receive(timeout=self.timeout)
+            if forward_msg.WhichOneof("type") == "file_urls_response" and forward_msg.file_urls_response.response_id == request_id:
+                file_urls = forward_msg.file_urls_response.file_urls[0]
+                break
+        response = requests.put(self.base_url + file_urls.upload_url, files={"file": (file_name, contents)}, timeout=self.timeout)
+        response.raise_for_status()
+
+        state = FileUploaderState()
+        state.uploaded_file_info.add(name=file_name, size=len(contents), file_id=file_urls.file_id, file_urls=file_urls)
+        self.widget_states[uploader.id] = ("file_uploader_state_value", state)
+        return self.run()
+
+    def errors(self):
+        return [
+            element for element in self.elements
+            if element.WhichOneof("type") == "exception"
+            or (element.WhichOneof("type") == "alert" and element.alert.format == element.alert.ERROR)
+        ]
@@ -0,0 +1,59 @@
+"""Report assembly time with and without the rendered-fragment cache.
+
+Builds the downloadable report for a batch of synthetic patients whose gene
+symbols and diplotypes are drawn from a fixed pool, once rendering every
+section and once through the fragment cache, and prints the hit rate.
+
+    python benchmarks/fragment_cache.py --patients 1000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from loadtest import FIXTURE_ALLELES, REPO_ROOT, fixture_diplotypes
+from rendering import synthetic_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--rows", type=int, default=20, help="result rows per gene symbol and diplotype")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    import report
+
+    # The same gene symbol and diplotype always has the same results, like the database
+    rng = random.Random(args.seed)
+    diplotypes = {genesymbol: [diplotype for diplotype, _, _ in fixture_diplotypes(genesymbol)] for genesymbol in FIXTURE_ALLELES}
+    results = {}
+    patients = []
+    for _ in range(args.patients):
+        gene_results = []
+        for genesymbol in sorted(FIXTURE_ALLELES):
+            diplotype = rng.choice(diplotypes[genesymbol])
+            if (genesymbol, diplotype) not in results:
+                results[genesymbol, diplotype] = synthetic_results(args.rows, seed=len(results))
+            gene_results.append((genesymbol, diplotype, results[genesymbol, diplotype]))
+        patients.append(gene_results)
+
+    timings = {}
+    for label, cpic_version in (("uncached", None), ("cached", "benchmark")):
+        started = time.perf_counter()
+        for gene_results in patients:
+            pairs = [(genesymbol, diplotype) for genesymbol, diplotype, _ in gene_results]
+            report.build_html_report("", "ID", "", pairs, gene_results, [], [], cpic_version=cpic_version)
+        timings[label] = time.perf_counter() - started
+
+    print(f"{args.patients} patients, {len(FIXTURE_ALLELES)} gene symbols each, {len(results)} distinct sections")
+    for label, elapsed in timings.items():
+        print(f"{label:10}{elapsed:>8.2f}s{elapsed / args.patients * 1000:>10.2f} ms/patient")
+    print(f"fragment cache: {report.get_fragment_cache().stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Server CPU time and payload size of the result views.
+
+Compares the old markdown blob (DataFrame.to_html pushed through st.markdown)
+with the Arrow table that st.dataframe sends to the browser.
+
+    python benchmarks/rendering.py --genes 9 --rows 40
+"""
+import argparse
+import random
+import time
+
+import pandas as pd
+import pyarrow as pa
+
+CLASSIFICATIONS = ["Strong", "Moderate", "Optional"]
+PHENOTYPES = ["Normal Metabolizer", "Intermediate Metabolizer", "Poor Metabolizer", "Ultrarapid Metabolizer"]
+
+
+def synthetic_results(rows, seed):
+    # Result rows shaped like the Home page query after the JSONB columns were flattened
+    rng = random.Random(seed)
+    return pd.DataFrame({
+        "activityscore": [f"CYP2D6: {rng.choice(['0.0', '0.5', '1.0', '1.5', '2.0'])}" for _ in range(rows)],
+        "phenotypes": [f"CYP2D6: {rng.choice(PHENOTYPES)}" for _ in range(rows)],
+        "ehrpriority": [rng.choice(["Normal/Routine/Low Risk", "Abnormal/Priority/High Risk"]) for _ in range(rows)],
+        "drugid": [f"RxNorm:{rng.randint(1000, 999999)}" for _ in range(rows)],
+        "name": [rng.choice(["codeine", "tramadol", "amitriptyline", "sertraline", "tamoxifen"]) for _ in range(rows)],
+        "population": ["general"] * rows,
+        "drugrecommendation": [" ".join(["Initiate therapy with recommended starting dose."] * rng.randint(2, 8)) for _ in range(rows)],
+        "classification": [rng.choice(CLASSIFICATIONS) for _ in range(rows)],
+    })
+
+
+def render_html(result_df, genesymbol, diplotype):
+    # What the result views used to send through st.markdown
+    html_report = f"<h3>Results for  {genesymbol}, {diplotype}</h3>\n"
+    html_report += "<div style='overflow-x:auto;'>\n"
+    html_report += result_df.to_html(index=False, escape=False, classes='report-table', table_id='report-table', justify='center')
+    html_report = html_report.replace('<th>', '<th style="background-color: #ADD8E6; color: black;">')
+    html_report += "\n</div>\n"
+    return html_report.encode("utf-8")
+
+
+def render_arrow(result_df):
+    # What st.dataframe sends: the DataFrame serialized as an Arrow IPC stream
+    table = pa.Table.from_pandas(result_df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def measure(render, frames, repeat):
+    started = time.process_time()
+    for _ in range(repeat):
+        payload = sum(len(render(*frame)) for frame in frames)
+    return (time.process_time() - started) / repeat, payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--genes", type=int, default=9, help="number of gene tables per report")
+    parser.add_argument("--rows", type=int, default=40, help="rows per gene table")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    frames = [(synthetic_results(args.rows, seed), f"GENE{seed}", "*1/*2") for seed in range(args.genes)]
+    html_cpu, html_bytes = measure(render_html, frames, args.repeat)
+    arrow_cpu, arrow_bytes = measure(lambda result_df, *_: render_arrow(result_df), frames, args.repeat)
+
+    print(f"{args.genes} tables x {args.rows} rows")
+    print(f"{'':12}{'CPU ms':>10}{'payload KB':>14}")
+    print(f"{'to_html':12}{html_cpu * 1000:>10.2f}{html_bytes / 1024:>14.1f}")
+    print(f"{'arrow':12}{arrow_cpu * 1000:>10.2f}{arrow_bytes / 1024:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Size of the downloadable report for the sample data.
+
+Builds the full and the compact report for `sample data/input_values.txt`
+and prints their size as HTML and zip. Uses db_url from the environment or
+.env, or starts the Docker Postgres with the fixture of loadtest.py.
+
+    python benchmarks/report_size.py
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+from loadtest import REPO_ROOT, load_cpic_fixture, start_postgres, stop_postgres
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--file", default="sample data/input_values.txt", help="patient file to build the report for")
+    parser.add_argument("--fixture", action="store_true", help="use a Docker Postgres with the generated CPIC fixture")
+    parser.add_argument("--port", type=int, default=55432, help="host port of the Docker Postgres")
+    args = parser.parse_args()
+
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+
+    container = None
+    if args.fixture:
+        container, os.environ["db_url"] = start_postgres(args.port)
+        load_cpic_fixture(os.environ["db_url"])
+    try:
+        import db
+        import report
+
+        with open(args.file) as file:
+            name, user_id, pairs = report.parse_patient_file(file.read())
+        results = report.collect_gene_results(pairs, db.fetch_pair_recommendations)
+    finally:
+        if container is not None:
+            stop_postgres(container)
+
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"{len(pairs)} gene symbols, {sum(len(result_df) for _, _, result_df in results[0])} result rows")
+    print(f"{'':10}{'HTML KB':>10}{'zip KB':>10}")
+    for label, compact in (("full", False), ("compact", True)):
+        html_report = report.build_html_report(name, user_id, timestamp, pairs, *results, compact=compact)
+        print(f"{label:10}{len(html_report.encode('utf-8')) / 1024:>10.1f}{len(report.zip_report(html_report)) / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+
+# Strength of a classification, a drug gets the strongest one found for a patient
+CLASSIFICATION_LABELS = np.array(["None", "Optional", "Moderate", "Strong"])
+CLASSIFICATION_RANK = {label: rank for rank, label in enumerate(CLASSIFICATION_LABELS)}
+
+
+def classifications_from_jobs(finished_jobs):
+    # One row per patient, drug and classification from the rows stored with each job
+    patient_ids = []
+    rows = []
+    for job in finished_jobs:
+        job_rows = json.loads(job["classifications"])
+        patient_ids += [job["patient_id"]] * len(job_rows)
+        rows += job_rows
+    classifications_df = pd.DataFrame(rows, columns=["drug", "classification"])
+    classifications_df.insert(0, "patient_id", patient_ids)
+    return classifications_df
+
+
+def classification_matrix(classifications_df):
+    # Patients x drugs matrix of the strongest classification rank, 0 where there is none
+    ranks = classifications_df["classification"].map(CLASSIFICATION_RANK).fillna(0).astype("int8")
+    return (
+        classifications_df.assign(rank=ranks)
+        .pivot_table(index="patient_id", columns="drug", values="rank", aggfunc="max", fill_value=0)
+        .astype("int8")
+    )
+
+
+def label_matrix(rank_matrix):
+    # Same matrix with the classification names instead of ranks
+    return pd.DataFrame(CLASSIFICATION_LABELS[rank_matrix.to_numpy()], index=rank_matrix.index, columns=rank_matrix.columns)
+
+
+def strong_patients_per_drug(rank_matrix):
+    return (rank_matrix == CLASSIFICATION_RANK["Strong"]).sum(axis=0).sort_values(ascending=False)
+
+
+def heatmap_frame(rank_matrix):
+    # Long form for the heatmap: one row per patient and drug
+    long_df = rank_matrix.reset_index().melt(id_vars="patient_id", var_name="drug", value_name="rank")
+    long_df["classification"] = CLASSIFICATION_LABELS[long_df["rank"].to_numpy()]
+    return long_df
+
+
+def to_parquet_bytes(matrix):
+    buffer = io.BytesIO()
+    matrix.reset_index().to_parquet(buffer, index=False)
+    return buffer.getvalue()
@@ -0,0 +1,457 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pandas as pd
+import streamlit as st
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2 import errors, pool
+
+import snapshot
+
+# Load environment variables from .env
+load_dotenv(".env")
+
+# Retrieve the DATABASE_URL from the environment
+DATABASE_URL = os.environ.get("db_url")
+
+# Maximum number of connections one server process keeps open
+POOL_MAX_CONNECTIONS = int(os.environ.get("PGX_POOL_MAX", "10"))
+
+# Number of query results (and as many last known good ones) kept per server process
+LOOKUP_CACHE_SIZE = int(os.environ.get("PGX_LOOKUP_CACHE_SIZE", "5000"))
+
+# Seconds a query waits for a free pooled connection before it fails
+POOL_WAIT_SECONDS = float(os.environ.get("PGX_POOL_WAIT_SECONDS", "10"))
+
+# Statement timeouts in milliseconds: the dropdown options are small lookups,
+# the recommendation queries join several tables
+OPTIONS_TIMEOUT_MS = int(os.environ.get("PGX_OPTIONS_TIMEOUT_MS", "2000"))
+QUERY_TIMEOUT_MS = int(os.environ.get("PGX_QUERY_TIMEOUT_MS", "5000"))
+
+# Seconds to wait for a new database connection
+CONNECT_TIMEOUT = int(os.environ.get("PGX_CONNECT_TIMEOUT", "5"))
+
+# Connection settings of every database connection. The statement timeout is
+# enforced by the server, TCP keepalives and the send timeout notice a server
+# that went away without closing its connections
+CONNECTION_OPTIONS = {
+    "connect_timeout": CONNECT_TIMEOUT,
+    "keepalives": 1,
+    "keepalives_idle": int(os.environ.get("PGX_KEEPALIVES_IDLE", "10")),
+    "keepalives_interval": int(os.environ.get("PGX_KEEPALIVES_INTERVAL", "5")),
+    "keepalives_count": int(os.environ.get("PGX_KEEPALIVES_COUNT", "3")),
+    "tcp_user_timeout": int(os.environ.get("PGX_TCP_USER_TIMEOUT_MS", "15000")),
+}
+
+# Failed queries in a row after which the database is not asked for a while
+BREAKER_FAILURES = int(os.environ.get("PGX_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("PGX_BREAKER_RESET_SECONDS", "30"))
+
+# Genes and drugs offered in the dropdown menus
+GENE_SYMBOLS = ('CYP2C9', 'SLCO1B1', 'CYP2D6', 'TPMT', 'CYP2B6', 'CYP3A5', 'NUDT15', 'UGT1A1', 'CYP2C19')
+DRUG_NAMES = ('efavirenz', 'sertraline', 'trimipramine', 'lansoprazole', 'citalopram', 'clomipramine', 'escitalopram', 'doxepin', 'pantoprazole', 'imipramine', 'amitriptyline', 'omeprazole', 'dexlansoprazole', 'fluvastatin', 'fosphenytoin', 'phenytoin', 'celecoxib', 'lornoxicam', 'tenoxicam', 'meloxicam', 'flurbiprofen', 'ibuprofen', 'piroxicam', 'tamoxifen', 'tramadol', 'vortioxetine', 'codeine', 'desipramine', 'paroxetine', 'atomoxetine', 'venlafaxine', 'fluvoxamine', 'hydrocodone', 'nortriptyline', 'tacrolimus', 'mercaptopurine', 'thioguanine', 'azathioprine', 'atazanavir', 'atorvastatin', 'lovastatin', 'pitavastatin', 'pravastatin', 'rosuvastatin', 'simvastatin', 'irinotecan', 'cisplatin')
+
+# Recommendations for a gene symbol and diplotype, one row per drug (Home page)
+PAIR_QUERY = """
+    SELECT DISTINCT ON (p.drugid)
+        {diplotype_column}
+        r.activityscore,
+        r.phenotypes,
+        dp.ehrpriority,
+        p.drugid,
+        dr.name,
+        r.population,
+        r.drugrecommendation,
+        r.classification
+    FROM cpic.gene_result_diplotype d
+    JOIN cpic.gene_result_lookup l ON d.functionphenotypeid = l.id
+    JOIN cpic.gene_result gr ON l.phenotypeid = gr.id
+    JOIN cpic.pair p ON gr.genesymbol = p.genesymbol
+    JOIN cpic.drug dr ON p.drugid = dr.drugid
+    JOIN cpic.recommendation r ON dr.drugid = r.drugid
+    JOIN cpic.diplotype_phenotype dp ON r.phenotypes @> dp.phenotype
+    WHERE dp.diplotype ->> %(genesymbol)s = %(diplotype)s
+        {drug_filter}
+        AND r.activityscore @> dp.activityscore
+        AND r.classification <> 'No Recommendation'
+        AND r.drugrecommendation <> 'No recommendation'
+    ORDER BY p.drugid, r.classification;
+"""
+
+# All phenotype combinations for a gene symbol and diplotype (Combinations page)
+COMBINATIONS_QUERY = """
+    SELECT DISTINCT
+        dp.diplotype,
+        r.activityscore,
+        r.phenotypes,
+        dp.ehrpriority,
+        p.drugid,
+        dr.name,
+        r.population,
+        r.drugrecommendation,
+        r.classification
+    FROM cpic.gene_result_diplotype d
+    JOIN cpic.gene_result_lookup l ON d.functionphenotypeid = l.id
+    JOIN cpic.gene_result gr ON l.phenotypeid = gr.id
+    JOIN cpic.pair p ON gr.genesymbol = p.genesymbol
+    JOIN cpic.drug dr ON p.drugid = dr.drugid
+    JOIN cpic.recommendation r ON dr.drugid = r.drugid
+    JOIN cpic.diplotype_phenotype dp ON r.phenotypes @> dp.phenotype
+    WHERE dp.diplotype ->> %(genesymbol)s = %(diplotype)s
+        {drug_filter}
+        AND r.activityscore @> dp.activityscore
+        AND r.classification <> 'No Recommendation'
+        AND r.drugrecommendation <> 'No recommendation'
+    ORDER BY p.drugid, r.classification;
+"""
+
+# Recommendations for a single drug
+DRUG_QUERY = """
+    select distinct d.name,
+        d.drugid,
+        r.drugrecommendation,
+        r.classification,
+        r.phenotypes
+    from cpic.drug d
+    join cpic.recommendation r on d.drugid = r.drugid
+    where name = %(drug)s
+    AND r.classification <> 'No Recommendation'
+    AND r.drugrecommendation <> 'No recommendation'
+    ORDER BY d.drugid, r.classification;
+"""
+
+
+@st.cache_resource
+def get_pool():
+    # One connection pool shared by every session of this server process
+    if DATABASE_URL is None:
+        raise RuntimeError("DATABASE_URL environment variable is not set.")
+    return pool.ThreadedConnectionPool(1, POOL_MAX_CONNECTIONS, DATABASE_URL, **CONNECTION_OPTIONS)
+
+
+@st.cache_resource
+def get_pool_slots():
+    # getconn() fails at once when every connection is in use, callers queue here instead
+    return threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+
+
+@contextmanager
+def get_cursor():
+    # Borrow a connection from the pool and hand it back when done
+    connection_pool = get_pool()
+    pool_slots = get_pool_slots()
+    if not pool_slots.acquire(timeout=POOL_WAIT_SECONDS):
+        raise pool.PoolError(f"No database connection became free within {POOL_WAIT_SECONDS:g}s")
+    try:
+        conn = connection_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            # A connection the server dropped is closed instead of reused
+            connection_pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        pool_slots.release()
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+# Errors after which a lookup is answered from its last known good result
+DATABASE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, pool.PoolError, DatabaseUnavailable)
+
+FALLBACK_WARNING = "The database is not responding, some results are from an earlier query and may be outdated."
+
+# Lookups of the current thread answered from their last known good result
+_fallbacks = threading.local()
+
+
+@contextmanager
+def track_fallbacks():
+    # Collects the keys of the lookups made inside the block that were answered
+    # from their last known good result, so the caller can say so
+    outer = getattr(_fallbacks, "keys", None)
+    keys = []
+    _fallbacks.keys = keys
+    try:
+        yield keys
+    finally:
+        _fallbacks.keys = outer
+        if outer is not None:
+            outer.extend(keys)
+
+
+def record_fallback(key):
+    keys = getattr(_fallbacks, "keys", None)
+    if keys is not None:
+        keys.append(key)
+
+
+class QueryStats:
+    # Counters of one server process, logged together with the events that change them
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"queries": 0, "timeouts": 0, "failures": 0, "rejected": 0, "breaker_trips": 0, "fallbacks": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+            return dict(self.counts)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+@st.cache_resource
+def get_query_stats():
+    return QueryStats()
+
+
+class CircuitBreaker:
+    # Stops sending queries to a database that keeps failing, so pages fail or
+    # fall back at once instead of waiting for every timeout. After the reset
+    # time one trial query is let through and closes the breaker again if it works
+
+    def __init__(self, failure_threshold, reset_seconds, query_stats):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.query_stats = query_stats
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def before_query(self):
+        with self.lock:
+            if self.opened_at is not None:
+                if self.trial_running or time.monotonic() - self.opened_at < self.reset_seconds:
+                    self.query_stats.count("rejected")
+                    raise DatabaseUnavailable("The database is not responding, please try again in a few seconds.")
+                self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def cancel_trial(self):
+        # The trial query never reached the database, the next query tries again
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+                counts = self.query_stats.count("breaker_trips")
+                print(f"Database circuit breaker open for {self.reset_seconds:.0f}s after {self.failures} failed queries: {counts}")
+
+
+@st.cache_resource
+def get_circuit_breaker():
+    return CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_SECONDS, get_query_stats())
+
+
+def run_query(sql_query, params=None, timeout_ms=QUERY_TIMEOUT_MS):
+    breaker = get_circuit_breaker()
+    query_stats = get_query_stats()
+    breaker.before_query()
+    query_stats.count("queries")
+    try:
+        with get_cursor() as cur:
+            # Only for this transaction, the pooled connection keeps the server default
+            cur.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+            cur.execute(sql_query, params)
+            # Convert the results to a Pandas DataFrame
+            result_df = pd.DataFrame(cur.fetchall(), columns=[desc[0] for desc in cur.description])
+    except errors.QueryCanceled:
+        counts = query_stats.count("timeouts")
+        print(f"Query cancelled after {timeout_ms} ms: {counts}")
+        breaker.record_failure()
+        raise
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        counts = query_stats.count("failures")
+        print(f"Query failed: {e}: {counts}")
+        breaker.record_failure()
+        raise
+    except pool.PoolError:
+        # Every connection is busy, the database itself may be fine
+        query_stats.count("rejected")
+        breaker.cancel_trial()
+        raise
+    except Exception:
+        # Errors in the query itself say nothing about the health of the database
+        breaker.record_success()
+        raise
+    breaker.record_success()
+    return result_df
+
+
+class LookupCache:
+    # Query results of one server process, keyed by lookup so the CPIC refresh
+    # can drop exactly the entries whose data changed. Dropped results are kept
+    # as last known good answers for when the database is slow or down. Both
+    # drop their least recently used results when they are full
+
+    def __init__(self, max_entries):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.last_good = OrderedDict()
+        self.max_entries = max_entries
+        self.generation = 0
+
+    def get(self, key, load):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                if key in self.last_good:
+                    self.last_good.move_to_end(key)
+            generation = self.generation
+        if value is None:
+            try:
+                value = load()
+            except DATABASE_ERRORS as e:
+                with self.lock:
+                    value = self.last_good.get(key)
+                if value is None:
+                    raise
+                counts = get_query_stats().count("fallbacks")
+                print(f"Answered {key} from the last known good result ({e}): {counts}")
+                record_fallback(key)
+                return value.copy()
+            with self.lock:
+                self.remember(self.last_good, key, value)
+                # A result loaded while an invalidation ran may already be outdated
+                if generation == self.generation:
+                    self.remember(self.entries, key, value)
+        # Callers modify the DataFrames they get, hand out copies
+        return value.copy()
+
+    def remember(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                del self.entries[key]
+            self.generation += 1
+        return len(keys)
+
+
+@st.cache_resource
+def get_lookup_cache():
+    return LookupCache(LOOKUP_CACHE_SIZE)
+
+
+def query_gene_symbols():
+    def load():
+        df = run_query("SELECT DISTINCT genesymbol FROM cpic.gene_result WHERE genesymbol IN %(genes)s", {"genes": GENE_SYMBOLS}, timeout_ms=OPTIONS_TIMEOUT_MS)
+        return ["None"] + sorted(df["genesymbol"].tolist())
+    return get_lookup_cache().get(("genes",), load)
+
+
+def query_diplotypes(genesymbol):
+    def load():
+        df = run_query(
+            "SELECT DISTINCT diplotype->>%(genesymbol)s AS simplified_diplotype FROM cpic.diplotype_phenotype WHERE jsonb_exists(diplotype, %(genesymbol)s)",
+            {"genesymbol": genesymbol},
+            timeout_ms=OPTIONS_TIMEOUT_MS,
+        )
+        return ["None"] + sorted(df["simplified_diplotype"].tolist())
+    return get_lookup_cache().get(("diplotypes", genesymbol), load)
+
+
+def query_drugs():
+    def load():
+        df = run_query("SELECT DISTINCT name FROM cpic.drug WHERE name IN %(drugs)s ORDER BY name", {"drugs": DRUG_NAMES}, timeout_ms=OPTIONS_TIMEOUT_MS)
+        return ["None"] + sorted(df["name"].tolist())
+    return get_lookup_cache().get(("drugs",), load)
+
+
+def query_pair_recommendations(genesymbol, diplotype, drug=None, include_diplotype=False):
+    sql_query = PAIR_QUERY.format(
+        diplotype_column="dp.diplotype," if include_diplotype else "",
+        drug_filter="AND dr.name = %(drug)s" if drug else "",
+    )
+    return get_lookup_cache().get(
+        ("pair", genesymbol, diplotype, drug, include_diplotype),
+        lambda: run_query(sql_query, {"genesymbol": genesymbol, "diplotype": diplotype, "drug": drug}),
+    )
+
+
+def query_combinations(genesymbol, diplotype, drug=None):
+    sql_query = COMBINATIONS_QUERY.format(drug_filter="AND dr.name = %(drug)s" if drug else "")
+    return get_lookup_cache().get(
+        ("combinations", genesymbol, diplotype, drug),
+        lambda: run_query(sql_query, {"genesymbol": genesymbol, "diplotype": diplotype, "drug": drug}),
+    )
+
+
+def query_drug_recommendations(drug):
+    return get_lookup_cache().get(("drug", drug), lambda: run_query(DRUG_QUERY, {"drug": drug}))
+
+
+# The lookups below are answered from the shared CPIC snapshot when one is
+# published, otherwise from the database through the cached queries above
+
+
+def load_gene_symbols():
+    cpic_snapshot = snapshot.get_snapshot()
+    if cpic_snapshot is not None:
+        return cpic_snapshot.gene_symbols()
+    return query_gene_symbols()
+
+
+def load_diplotypes(genesymbol):
+    cpic_snapshot = snapshot.get_snapshot()
+    if cpic_snapshot is not None:
+        return cpic_snapshot.diplotypes(genesymbol)
+    return query_diplotypes(genesymbol)
+
+
+def load_drugs():
+    cpic_snapshot = snapshot.get_snapshot()
+    if cpic_snapshot is not None:
+        return cpic_snapshot.drugs()
+    return query_drugs()
+
+
+def fetch_pair_recommendations(genesymbol, diplotype, drug=None, include_diplotype=False):
+    cpic_snapshot = snapshot.get_snapshot()
+    if cpic_snapshot is not None:
+        return cpic_snapshot.pair_recommendations(genesymbol, diplotype, drug, include_diplotype)
+    return query_pair_recommendations(genesymbol, diplotype, drug, include_diplotype)
+
+
+def fetch_combinations(genesymbol, diplotype, drug=None):
+    cpic_snapshot = snapshot.get_snapshot()
+    if cpic_snapshot is not None:
+        return cpic_snapshot.combinations(genesymbol, diplotype, drug)
+    return query_combinations(genesymbol, diplotype, drug)
+
+
+def fetch_drug_recommendations(drug):
+    cpic_snapshot = snapshot.get_snapshot()
+    if cpic_snapshot is not None:
+        return cpic_snapshot.drug_recommendations(drug)
+    return query_drug_recommendations(drug)
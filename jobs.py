@@ -0,0 +1,303 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from io import StringIO
+
+import pandas as pd
+import streamlit as st
+
+import db
+import refresh
+import report
+
+# SQLite file where jobs and finished reports are kept
+JOBS_DB = os.environ.get("PGX_JOBS_DB", "jobs.db")
+
+# Number of reports analyzed at the same time
+JOB_WORKERS = int(os.environ.get("PGX_JOB_WORKERS", "2"))
+
+# Maximum number of database connections the jobs may use together,
+# the rest of the pool stays free for interactive users
+JOB_DB_SLOTS = int(os.environ.get("PGX_JOB_DB_SLOTS", "2"))
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        patient_id TEXT,
+        name TEXT,
+        status TEXT NOT NULL,
+        progress INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        submitted_at TEXT NOT NULL,
+        finished_at TEXT,
+        error TEXT,
+        file_contents TEXT NOT NULL,
+        results TEXT,
+        html_report TEXT
+    );
+    CREATE INDEX IF NOT EXISTS jobs_patient_id ON jobs (patient_id, submitted_at);
+"""
+
+
+# Columns added after the first release, added to existing job stores on start
+ADDED_COLUMNS = {
+    # Server process that runs the job, a job whose owner is gone will never finish
+    "owner_pid": "INTEGER",
+    "owner_boot": "TEXT",
+    # Compressed copy of html_report for the zip download
+    "report_zip": "BLOB",
+    # JSON list of the [drug, classification] result rows for the cohort view
+    "classifications": "TEXT",
+    # 1 when some results were last known good answers while the database was down
+    "fallback": "INTEGER NOT NULL DEFAULT 0",
+}
+
+# Changes on every reboot, so an old pid of a job can't match a new process
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+_initialized_paths = set()
+_init_lock = threading.Lock()
+
+
+def init_db(path):
+    # Create the schema once per process, WAL mode is kept in the file itself
+    with _init_lock:
+        if path in _initialized_paths:
+            return
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            existing_columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in ADDED_COLUMNS.items():
+                if column not in existing_columns:
+                    try:
+                        conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+                    except sqlite3.OperationalError as e:
+                        # Another server process added it first
+                        if "duplicate column" not in str(e):
+                            raise
+            conn.commit()
+        finally:
+            conn.close()
+        _initialized_paths.add(path)
+
+
+@contextmanager
+def connect():
+    # A short-lived connection per call, sqlite3 connections can't be shared between threads
+    init_db(JOBS_DB)
+    conn = sqlite3.connect(JOBS_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def boot_id():
+    try:
+        with open(BOOT_ID_FILE, "r") as file:
+            return file.read().strip()
+    except OSError:
+        return ""
+
+
+def owner_alive(owner_pid, owner_boot):
+    if owner_pid is None or owner_boot != boot_id():
+        return False
+    try:
+        os.kill(owner_pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running under another user
+        return True
+    return True
+
+
+def update_job(job_id, **fields):
+    assignments = ", ".join(f"{field} = ?" for field in fields)
+    with connect() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+@st.cache_resource
+def get_executor():
+    # Jobs left unfinished by a server process that is gone will never complete,
+    # jobs of other running server processes sharing the job store are left alone
+    with connect() as conn:
+        rows = conn.execute("SELECT id, owner_pid, owner_boot FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        orphaned_ids = [row["id"] for row in rows if not owner_alive(row["owner_pid"], row["owner_boot"])]
+        conn.executemany(
+            "UPDATE jobs SET status = 'failed', error = 'Interrupted by a server restart' WHERE id = ?",
+            [(job_id,) for job_id in orphaned_ids],
+        )
+    return ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="pgx-job")
+
+
+@st.cache_resource
+def get_db_slots():
+    return threading.BoundedSemaphore(JOB_DB_SLOTS)
+
+
+def submit_job(file_contents):
+    name, user_id, pairs = report.parse_patient_file(file_contents)
+    job_id = uuid.uuid4().hex
+    executor = get_executor()
+    with connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, patient_id, name, status, total, submitted_at, file_contents, owner_pid, owner_boot) "
+            "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, user_id, name, len(pairs), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), file_contents, os.getpid(), boot_id()),
+        )
+    executor.submit(run_job, job_id, get_db_slots())
+    return job_id
+
+
+def run_job(job_id, db_slots):
+    job = get_job(job_id)
+    update_job(job_id, status="running")
+    try:
+        name, user_id, pairs = report.parse_patient_file(job["file_contents"])
+
+        def fetch(genesymbol, diplotype):
+            with db_slots:
+                return db.fetch_pair_recommendations(genesymbol, diplotype)
+
+        def on_progress(done):
+            update_job(job_id, progress=done)
+
+        cpic_version = refresh.current_version()
+        with db.track_fallbacks() as fallbacks:
+            gene_results, genes_with_no_results, strong_classification_genes = report.collect_gene_results(pairs, fetch, on_progress)
+        if fallbacks:
+            # Sections of possibly outdated results must not be cached under the current CPIC version
+            print(f"Job {job_id} used last known good results for {fallbacks}")
+            cpic_version = None
+        html_report = report.build_html_report(
+            name, user_id, job["submitted_at"], pairs, gene_results, genes_with_no_results, strong_classification_genes,
+            cpic_version=cpic_version,
+        )
+        results = {
+            "gene_results": [
+                {"genesymbol": genesymbol, "diplotype": diplotype, "table": result_df.to_json(orient="split", index=False)}
+                for genesymbol, diplotype, result_df in gene_results
+            ],
+            "no_results": genes_with_no_results,
+            "strong_classification": strong_classification_genes,
+        }
+        update_job(
+            job_id,
+            status="finished",
+            finished_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            results=json.dumps(results),
+            html_report=html_report,
+            report_zip=report.zip_report(html_report),
+            classifications=json.dumps(classification_rows(gene_results)),
+            fallback=int(bool(fallbacks)),
+        )
+        print(f"Job {job_id} finished, report fragment cache: {report.get_fragment_cache().stats()}")
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        update_job(job_id, status="failed", finished_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), error=str(e))
+
+
+def get_job(job_id):
+    with connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row is not None else None
+
+
+def job_statuses(job_ids):
+    # Status of every job of a batch in one query, without the stored reports
+    with connect() as conn:
+        rows = conn.execute(
+            "SELECT id, patient_id, status, error FROM jobs WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(job_ids)),),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def find_jobs(patient_id):
+    # Finished reports of a patient, newest first
+    with connect() as conn:
+        rows = conn.execute(
+            "SELECT id, name, submitted_at FROM jobs WHERE patient_id = ? AND status IN ('finished', 'stale') ORDER BY submitted_at DESC",
+            (patient_id,),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def latest_reports(job_ids=None):
+    # Latest finished report of every patient, optionally only among the given jobs.
+    # The ids go in as one JSON array, a batch can have more jobs than SQLite allows parameters
+    query = """
+        SELECT id, patient_id, classifications FROM (
+            SELECT id, patient_id, classifications,
+                row_number() OVER (PARTITION BY patient_id ORDER BY submitted_at DESC, rowid DESC) AS latest
+            FROM jobs
+            WHERE status IN ('finished', 'stale') {job_filter}
+        )
+        WHERE latest = 1
+    """
+    params = ()
+    job_filter = ""
+    if job_ids is not None:
+        job_filter = "AND id IN (SELECT value FROM json_each(?))"
+        params = (json.dumps(list(job_ids)),)
+    with connect() as conn:
+        rows = conn.execute(query.format(job_filter=job_filter), params).fetchall()
+    finished_jobs = [dict(row) for row in rows]
+
+    # Reports finished before the classifications were stored get them on their first use
+    for job in finished_jobs:
+        if job["classifications"] is None:
+            gene_results, _, _ = load_results(get_job(job["id"]))
+            job["classifications"] = json.dumps(classification_rows(gene_results))
+            update_job(job["id"], classifications=job["classifications"])
+    return finished_jobs
+
+
+def classification_rows(gene_results):
+    return [
+        [drug, classification]
+        for _, _, result_df in gene_results
+        for drug, classification in zip(result_df["name"], result_df["classification"])
+    ]
+
+
+def report_zip(job):
+    # Reports finished before the zip was stored get it on their first download
+    if job["report_zip"] is None:
+        job["report_zip"] = report.zip_report(job["html_report"])
+        update_job(job["id"], report_zip=job["report_zip"])
+    return job["report_zip"]
+
+
+def load_results(job):
+    # Rebuild the gene results of a finished job from the stored JSON
+    results = json.loads(job["results"])
+    gene_results = [
+        (item["genesymbol"], item["diplotype"], pd.read_json(StringIO(item["table"]), orient="split", dtype=False))
+        for item in results["gene_results"]
+    ]
+    return gene_results, results["no_results"], results["strong_classification"]
+
+
+def invalidate_reports(is_affected):
+    # Mark finished reports stale when CPIC data of one of their gene symbols and diplotypes changed
+    with connect() as conn:
+        rows = conn.execute("SELECT id, file_contents FROM jobs WHERE status = 'finished'").fetchall()
+        stale_ids = [
+            row["id"] for row in rows
+            if any(is_affected(genesymbol, diplotype) for genesymbol, diplotype in report.parse_patient_file(row["file_contents"])[2])
+        ]
+        conn.executemany("UPDATE jobs SET status = 'stale' WHERE id = ?", [(job_id,) for job_id in stale_ids])
+    return len(stale_ids)
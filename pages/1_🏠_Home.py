@@ -1,12 +1,11 @@
 import streamlit as st
 import pandas as pd
-import psycopg2
-import os
-from datetime import datetime
-from dotenv import load_dotenv
 
-# Load environment variables from .env
-load_dotenv(".env")
+import db
+import jobs
+import report
+from report import show_result_table
+from warmup import warm_up
 
 st.set_page_config(
     layout="wide",
@@ -14,14 +13,16 @@ st.set_page_config(
     page_icon="🔎"
 )
 
-# Retrieve the DATABASE_URL from the environment
-DATABASE_URL = os.environ.get("db_url")
-
 # Check if the database URL is set
-if DATABASE_URL is None:
+if db.DATABASE_URL is None:
     st.error("DATABASE_URL environment variable is not set.")
-
-conn = psycopg2.connect(DATABASE_URL)
+else:
+    # Preload the caches once per server process. Without the database the page
+    # still shows what it can, its own lookups report the error
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
 
 # Custom Streamlit app header
 st.markdown(
@@ -78,97 +79,22 @@ def execute_custom_query(selected_gene_symbol, selected_diplotypes, selected_dru
     if selected_gene_symbol == "None" and selected_diplotypes == "None" and selected_drug == "None":
         # Return all data if "None" is selected in all dropdowns
         print("No input selected")
+        return pd.DataFrame()
     elif selected_gene_symbol and selected_diplotypes and selected_drug and selected_drug != "None":
-        # Construct the SQL query for gene symbol, diplotypes, and drug
-        sql_query = f"""
-            SELECT DISTINCT ON (p.drugid)
-                r.activityscore,
-                r.phenotypes,
-                dp.ehrpriority,
-                p.drugid,
-                dr.name,
-                r.population,
-                r.drugrecommendation,
-                r.classification
-            FROM cpic.gene_result_diplotype d
-            JOIN cpic.gene_result_lookup l ON d.functionphenotypeid = l.id
-            JOIN cpic.gene_result gr ON l.phenotypeid = gr.id
-            JOIN cpic.pair p ON gr.genesymbol = p.genesymbol
-            JOIN cpic.drug dr ON p.drugid = dr.drugid
-            JOIN cpic.recommendation r ON dr.drugid = r.drugid
-            JOIN cpic.diplotype_phenotype dp ON r.phenotypes @> dp.phenotype
-            WHERE dp.diplotype ->> '{selected_gene_symbol}' = '{selected_diplotypes}'
-                AND dr.name = '{selected_drug}'
-                AND r.activityscore @> dp.activityscore
-                AND r.classification <> 'No Recommendation'
-                AND r.drugrecommendation <> 'No recommendation'
-            ORDER BY p.drugid, r.classification;
-        """
+        # Recommendations for gene symbol, diplotypes, and drug
+        return db.fetch_pair_recommendations(selected_gene_symbol, selected_diplotypes, selected_drug)
     elif selected_gene_symbol and selected_diplotypes:
-        # Construct the SQL query for gene symbol and diplotypes without filtering by drug name
-        sql_query = f"""
-            SELECT DISTINCT ON (p.drugid)
-                r.activityscore,
-                r.phenotypes,
-                dp.ehrpriority,
-                p.drugid,
-                dr.name,
-                r.population,
-                r.drugrecommendation,
-                r.classification
-            FROM cpic.gene_result_diplotype d
-            JOIN cpic.gene_result_lookup l ON d.functionphenotypeid = l.id
-            JOIN cpic.gene_result gr ON l.phenotypeid = gr.id
-            JOIN cpic.pair p ON gr.genesymbol = p.genesymbol
-            JOIN cpic.drug dr ON p.drugid = dr.drugid
-            JOIN cpic.recommendation r ON dr.drugid = r.drugid
-            JOIN cpic.diplotype_phenotype dp ON r.phenotypes @> dp.phenotype
-            WHERE dp.diplotype ->> '{selected_gene_symbol}' = '{selected_diplotypes}'
-                AND r.activityscore @> dp.activityscore
-                AND r.classification <> 'No Recommendation'
-                AND r.drugrecommendation <> 'No recommendation'
-            ORDER BY p.drugid, r.classification;
-        """
+        # Recommendations for gene symbol and diplotypes without filtering by drug name
+        return db.fetch_pair_recommendations(selected_gene_symbol, selected_diplotypes)
     elif selected_drug:
-        sql_query = f"""
-            select distinct d.name,
-	            d.drugid,
-	            r.drugrecommendation,
-	            r.classification,
-	            r.phenotypes
-            from cpic.drug d
-            join cpic.recommendation r on d.drugid = r.drugid
-            where name = '{selected_drug}'
-            AND r.classification <> 'No Recommendation'
-            AND r.drugrecommendation <> 'No recommendation'
-            ORDER BY d.drugid, r.classification;
-        """
-    else:
-        # Handle other cases or provide a default query
-        sql_query = ""
-
-    # Execute the SQL query
-    if sql_query:
-        cur = conn.cursor()
-        cur.execute(sql_query)
-
-        # Fetch the results
-        result = cur.fetchall()
-
-        # Convert the results to a Pandas DataFrame
-        df = pd.DataFrame(result, columns=[desc[0] for desc in cur.description])
-
-        return df
+        return db.fetch_drug_recommendations(selected_drug)
     else:
         return pd.DataFrame()  # Return an empty DataFrame if no query is selected
 
-def main():
+def show_lookup():
     try:
-        cur = conn.cursor()
-
-        # Query to get all unique gene symbols from cpic.gene_result table
-        cur.execute("SELECT DISTINCT genesymbol FROM cpic.gene_result WHERE genesymbol IN ('CYP2C9', 'SLCO1B1', 'CYP2D6', 'TPMT', 'CYP2B6', 'CYP3A5', 'NUDT15', 'UGT1A1', 'CYP2C19')")
-        gene_symbols = ["None"] + sorted([row[0] for row in cur.fetchall()])
+        # Get all unique gene symbols from cpic.gene_result table
+        gene_symbols = db.load_gene_symbols()
 
         # Create the second popover for simplified diplotypes related to the selected gene symbol
         with st.expander("Select Gene Symbol"):
@@ -177,9 +103,8 @@ def main():
         if st.session_state.selected_gene_symbol != selected_gene_symbol:
             st.session_state.selected_gene_symbol = selected_gene_symbol
         
-        # Query to get all unique diplotypes for the selected gene symbol from cpic.diplotype_phenotype table
-        cur.execute(f"SELECT DISTINCT diplotype->>'{selected_gene_symbol}' AS simplified_diplotype FROM cpic.diplotype_phenotype WHERE jsonb_exists(diplotype, '{selected_gene_symbol}')")
-        diplotypes = ["None"] + sorted([row[0] for row in cur.fetchall()])
+        # Get all unique diplotypes for the selected gene symbol from cpic.diplotype_phenotype table
+        diplotypes = db.load_diplotypes(selected_gene_symbol)
         st.session_state.diplotypes = diplotypes
 
         # Create the third dropdown for diplotypes
@@ -189,9 +114,8 @@ def main():
         if st.session_state.selected_diplotypes != selected_diplotypes:
             st.session_state.selected_diplotypes = selected_diplotypes
 
-        # Query to get all unique drugs
-        cur.execute("SELECT DISTINCT name FROM cpic.drug WHERE name IN ('efavirenz','sertraline','trimipramine','lansoprazole','citalopram','clomipramine','escitalopram','doxepin','pantoprazole','imipramine','amitriptyline','omeprazole','dexlansoprazole','fluvastatin','fosphenytoin','phenytoin','celecoxib','lornoxicam','tenoxicam','meloxicam','flurbiprofen','ibuprofen','piroxicam','tamoxifen','tramadol','vortioxetine','codeine','desipramine','paroxetine','atomoxetine','venlafaxine','fluvoxamine','hydrocodone','nortriptyline','tacrolimus','mercaptopurine','thioguanine','azathioprine','atazanavir','atorvastatin','lovastatin','pitavastatin','pravastatin','rosuvastatin','simvastatin','irinotecan','cisplatin') ORDER BY name")
-        drugs = ["None"] + sorted([row[0] for row in cur.fetchall()])
+        # Get all unique drugs
+        drugs = db.load_drugs()
 
         # Create the third dropdown for drugs
         with st.expander("Select Drug"):
@@ -226,17 +150,10 @@ def main():
 
             # Check if there are results to add to the HTML report
             if not result_df.empty:
-                # Add the result DataFrame to the HTML report with styling to fit the page
-                html_report = f"<a name='{selected_gene_symbol}_{selected_diplotypes}'></a>\n"
-                html_report += f"<h3>Results for  {selected_gene_symbol}, {selected_diplotypes}</h3>\n"
-                html_report += "<div style='overflow-x:auto;'>\n"
-                html_report += result_df.to_html(index=False, escape=False, classes='report-table', table_id='report-table', justify='center')
-                html_report = html_report.replace('<th>', '<th style="background-color: #ADD8E6; color: black;">')
-                html_report += "\n"
-                html_report += "</div>\n"
-
-                # Display the HTML report
-                st.markdown(html_report, unsafe_allow_html=True)
+                # Display the results as an interactive table
+                st.markdown(f"<a name='{selected_gene_symbol}_{selected_diplotypes}'></a>", unsafe_allow_html=True)
+                st.markdown(f"### Results for  {selected_gene_symbol}, {selected_diplotypes}")
+                show_result_table(result_df)
             
             else:
                 st.warning(f"No results found for Genesymbol: {selected_gene_symbol}, Diplotype: {selected_diplotypes}")
@@ -244,84 +161,41 @@ def main():
     except Exception as e:
         st.error(f"Error: {str(e)}")
 
-    finally:
-        # Close cursor and connection if they are defined
-        if cur:
-            cur.close()
-
-if uploaded_file is not None:
-    # Read the content of the file and decode bytes to string
-    file_contents = uploaded_file.read().decode('utf-8')
-
-    # Extract name, id, and timestamp
-    lines = file_contents.split('\n')
-    name = lines[0].split(':')[-1].strip()
-    user_id = lines[1].split(':')[-1].strip()
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # Initialize the HTML string
-    html_report = ""
-
-    # Assume the file content contains genesymbol and diplotype separated by a comma
-    pairs = [line.split(',') for line in lines[3:]]
-
-    queried_genes = []  # Move the initialization here
+@st.fragment(run_every=1)
+def show_job_progress(job_id):
+    # Poll the job store until the background job is done
+    job = jobs.get_job(job_id)
+    if job["status"] in ("queued", "running"):
+        st.progress(job["progress"] / max(job["total"], 1), text=f"Analyzing {job['progress']} of {job['total']} gene symbols...")
+    else:
+        st.rerun()
+
+def show_report(job, key_prefix):
+    # The same report can be shown twice on the page, the prefix keeps its widget keys apart
+    gene_results, genes_with_no_results, strong_classification_genes = jobs.load_results(job)
+
+    # CPIC data of this report changed after it was made, or the database was down while it was made
+    if job["status"] == "stale" or job["fallback"]:
+        if job["status"] == "stale":
+            st.warning("The CPIC recommendations for some of these genes were updated after this report was made.")
+        if job["fallback"]:
+            st.warning("The database was not responding while this report was made, some results may be outdated.")
+        if st.button("Analyze again", key=f"{key_prefix}_rerun_{job['id']}"):
+            st.session_state.job_id = jobs.submit_job(job["file_contents"])
+            st.rerun()
 
     # Display name, id, and timestamp at the top
-    if name:
-        st.write(f"**Name:** {name}")
+    if job["name"]:
+        st.write(f"**Name:** {job['name']}")
     else:
         st.write(f"**Name:** Not Provided")
-    st.write(f"**ID:** {user_id}")
-    st.write(f"**Timestamp:** {timestamp}")
-
-    # Initialize a list to store genes with no results
-    genes_with_no_results = []
-
-    # Initialize a list to store gene symbols with strong classification
-    strong_classification_genes = []
+    st.write(f"**ID:** {job['patient_id']}")
+    st.write(f"**Timestamp:** {job['submitted_at']}")
 
     # Display the queried genes at the beginning
     st.write("**Queried genes:**")
-    for pair in pairs:
-        if len(pair) == 2:
-            genesymbol, diplotype = pair
-            st.write(f"{genesymbol} {diplotype}")
-
-    for idx, pair in enumerate(pairs, start=1):
-        # Check if the pair contains both genesymbol and diplotype
-        if len(pair) == 2:
-            genesymbol, diplotype = pair
-
-            # Execute the SQL query with the provided genesymbol and diplotype
-            result_df = execute_custom_query(genesymbol.strip(), diplotype.strip(), selected_drug="None")
-
-            # Check if the DataFrame is not empty before processing
-            if not result_df.empty:
-                # Process columns with JSONB format to remove {}
-                for col in result_df.columns:
-                    if isinstance(result_df[col][0], dict):
-                        result_df[col] = result_df[col].apply(lambda x: ', '.join([f"{k}: {v}" for k, v in x.items()]))
-
-                # Add the result DataFrame to the HTML report
-                html_report += f"""
-<div>
-    <h4><strong>Gene:</strong> {genesymbol}</h4>
-    <h4><strong>Diplotype:</strong> {diplotype}</h4>
-</div>
-"""
-                # Highlight the "name" column if it contains any of the specified drugs
-                html_report += result_df.to_html(index=False, escape=False, classes='report-table', table_id=f'report-table-{genesymbol}_{diplotype}', justify='center') 
-                html_report = html_report.replace('<th>', '<th style="background-color: #ADD8E6; color: black;">')
-                html_report += "\n"
-
-                # Check if the classification is strong
-                if "Strong" in result_df["classification"].values:
-                    # Add the gene symbol and diplotype as a tuple to the list for strong classification
-                    strong_classification_genes.append(f"{genesymbol} {diplotype}")
-            else:
-                # Add the gene symbol and diplotype to a list of genes with no results
-                genes_with_no_results.append(f"{genesymbol}, {diplotype}")
+    for genesymbol, diplotype in report.parse_patient_file(job["file_contents"])[2]:
+        st.write(f"{genesymbol} {diplotype}")
 
     # Display genes with no results
     if genes_with_no_results:
@@ -335,86 +209,77 @@ if uploaded_file is not None:
         for gene in strong_classification_genes:
             st.write(gene)
 
-        html_report += "<br>\n"
-    
     st.write("#")
-    # Display the entire HTML report
-    st.markdown(html_report, unsafe_allow_html=True)
+    # Display the results of each gene symbol and diplotype as an interactive table
+    for genesymbol, diplotype, result_df in gene_results:
+        st.markdown(f"#### **Gene:** {genesymbol}")
+        st.markdown(f"#### **Diplotype:** {diplotype}")
+        show_result_table(result_df)
     st.write("#")
 
-    # Disclaimer text
-    disclaimer = """
-    <div style='text-align: justify; font-size:10px'>
-    Disclaimer:<br>
-    The recommendations provided in this report are generated based on the available data and algorithms. It is crucial to note that these recommendations should only be considered as supplementary information and not as a substitute for professional medical advice. This report is intended for use by qualified healthcare professionals, and decisions regarding patient care should be made in consultation with a licensed medical practitioner. The information presented here may not encompass all aspects of an individual's medical history or current health condition.<br>
-    The developers and providers of this report disclaim any liability for the accuracy, completeness, or usefulness of the recommendations, and they are not responsible for any adverse consequences resulting from the use of this information.<br>
-    Patients and healthcare providers are encouraged to exercise their professional judgment and consider individual patient characteristics when making medical decisions.
-    </div>
-    """
-
-    st.markdown(disclaimer, unsafe_allow_html=True)
-
-    # Function to read the HTML template
-    def read_html_template(file_path):  
-        with open(file_path, 'r') as file:
-            template = file.read()
-        return template
-
-    # Path to your HTML template
-    template_path = 'index.html'
-
-    # Read the HTML template
-    html_report = read_html_template(template_path)
-
-    # Replace placeholders with actual values
-    html_report = html_report.replace('{{name}}', name)
-    html_report = html_report.replace('{{user_id}}', user_id)
-    html_report = html_report.replace('{{timestamp}}', timestamp)
-    html_report = html_report.replace('{{disclaimer}}', disclaimer)
-    queried_genes_html = "<ul>" + "".join([f"<li>{gene}</li>" for gene in queried_genes]) + "</ul>"
-    no_results_html = "<ul>" + "".join([f"<li>{gene}</li>" for gene in genes_with_no_results]) + "</ul>"
-    strong_classification_html = "<ul>" + "".join([f"<li>{gene}</li>" for gene in strong_classification_genes]) + "</ul>"
-
-    html_report = html_report.replace('{{queried_genes}}', queried_genes_html)
-    html_report = html_report.replace('{{no_results}}', no_results_html)
-    html_report = html_report.replace('{{strong_classification}}', strong_classification_html)
-
-    for idx, pair in enumerate(pairs, start=1):
-        # Check if the pair contains both genesymbol and diplotype
-        if len(pair) == 2:
-            genesymbol, diplotype = pair
-
-            # Execute the SQL query with the provided genesymbol and diplotype
-            result_df = execute_custom_query(genesymbol.strip(), diplotype.strip(), selected_drug="None")
-
-            # Check if the DataFrame is not empty before processing
-            if not result_df.empty:
-                # Process columns with JSONB format to remove {}
-                for col in result_df.columns:
-                    if isinstance(result_df[col][0], dict):
-                        result_df[col] = result_df[col].apply(lambda x: ', '.join([f"{k}: {v}" for k, v in x.items()]))
-
-                # Add the result DataFrame to the HTML report
-                html_report += f"""
-<div style="font-size: 20px;">
-    <p><strong>Gene:</strong> {genesymbol}</p>
-    <p><strong>Diplotype:</strong> {diplotype}</p>
-</div>
-"""
-                # Highlight the "name" column if it contains any of the specified drugs
-                html_report += result_df.to_html(index=False, escape=False, classes='report-table', table_id=f'report-table-{genesymbol}_{diplotype}', justify='center')
-                html_report = html_report.replace('<th>', '<th style="background-color: #ADD8E6; color: black;">')
-                html_report += "\n"
+    st.markdown(report.DISCLAIMER, unsafe_allow_html=True)
 
     st.write("#")
 
-    # Add download button for the HTML report
-    st.download_button(
+    # Add download buttons for the HTML report and a compressed copy
+    html_col, zip_col = st.columns([1, 1])
+    html_col.download_button(
         label="Download Report",
-        data = html_report,
+        data = job["html_report"],
         file_name="full_report.html",
-        mime="text/html"
+        mime="text/html",
+        key=f"{key_prefix}_download_{job['id']}",
+    )
+    zip_col.download_button(
+        label="Download Report (.zip)",
+        data = jobs.report_zip(job),
+        file_name="full_report.zip",
+        mime="application/zip",
+        key=f"{key_prefix}_download_zip_{job['id']}",
     )
-   
+
+if uploaded_file is not None:
+    # Submit each uploaded file once, the analysis runs in the background and survives reruns
+    if st.session_state.get('uploaded_file_id') != uploaded_file.file_id:
+        file_contents = uploaded_file.getvalue().decode('utf-8')
+        st.session_state.job_id = jobs.submit_job(file_contents)
+        st.session_state.uploaded_file_id = uploaded_file.file_id
+elif st.session_state.get('uploaded_file_id') is not None:
+    # The uploaded file was removed, stop showing its report
+    st.session_state.job_id = None
+    st.session_state.uploaded_file_id = None
+
+if st.session_state.get('job_id') is not None:
+    job = jobs.get_job(st.session_state.job_id)
+    if job["status"] in ("queued", "running"):
+        show_job_progress(job["id"])
+    elif job["status"] == "failed":
+        st.error(f"Error: {job['error']}")
+    else:
+        show_report(job, "current")
+
+# Finished reports are kept and can be opened again later
+with st.expander("Retrieve a previous report"):
+    patient_id = st.text_input("Patient ID")
+    if patient_id:
+        previous_jobs = jobs.find_jobs(patient_id.strip())
+        if previous_jobs:
+            selected_job = st.selectbox(
+                "Report",
+                previous_jobs,
+                format_func=lambda previous_job: f"{previous_job['submitted_at']} {previous_job['name'] or ''}",
+            )
+            show_report(jobs.get_job(selected_job["id"]), "previous")
+        else:
+            st.warning(f"No reports found for ID: {patient_id}")
+
+def main():
+    # Warn once when the database was down and cached results were shown instead
+    warning = st.empty()
+    with db.track_fallbacks() as fallbacks:
+        show_lookup()
+    if fallbacks:
+        warning.warning(db.FALLBACK_WARNING)
+
 if __name__ == "__main__":
     main()
@@ -1,11 +1,9 @@
 import streamlit as st
 import pandas as pd
-import psycopg2
-import os
-from dotenv import load_dotenv
 
-# Load environment variables from .env
-load_dotenv(".env")
+import db
+from report import show_result_table
+from warmup import warm_up
 
 st.set_page_config(
     layout="wide",
@@ -13,14 +11,16 @@ st.set_page_config(
     page_icon="link-45deg",
 )
 
-# Retrieve the DATABASE_URL from the environment
-DATABASE_URL = os.environ.get("db_url")
-
 # Check if the database URL is set
-if DATABASE_URL is None:
+if db.DATABASE_URL is None:
     st.error("DATABASE_URL environment variable is not set.")
-
-conn = psycopg2.connect(DATABASE_URL)
+else:
+    # Preload the caches once per server process. Without the database the page
+    # still shows what it can, its own lookups report the error
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
 
 # Custom Streamlit app header
 st.markdown(
@@ -54,115 +54,36 @@ def execute_custom_query(selected_gene_symbol, selected_diplotypes, selected_dru
     if selected_gene_symbol == "None" and selected_diplotypes == "None" and selected_drug == "None":
         # Return all data if "None" is selected in all dropdowns
         print("No input selected")
+        return pd.DataFrame()
     elif selected_gene_symbol and selected_diplotypes and selected_drug and selected_drug != "None":
-        # Construct the SQL query for gene symbol, diplotypes, and drug
-        sql_query = f"""
-            SELECT DISTINCT
-                dp.diplotype,
-                r.activityscore,
-                r.phenotypes,
-                dp.ehrpriority,
-                p.drugid,
-                dr.name,
-                r.population,
-                r.drugrecommendation,
-                r.classification
-            FROM cpic.gene_result_diplotype d
-            JOIN cpic.gene_result_lookup l ON d.functionphenotypeid = l.id
-            JOIN cpic.gene_result gr ON l.phenotypeid = gr.id
-            JOIN cpic.pair p ON gr.genesymbol = p.genesymbol
-            JOIN cpic.drug dr ON p.drugid = dr.drugid
-            JOIN cpic.recommendation r ON dr.drugid = r.drugid
-            JOIN cpic.diplotype_phenotype dp ON r.phenotypes @> dp.phenotype
-            WHERE dp.diplotype ->> '{selected_gene_symbol}' = '{selected_diplotypes}'
-                AND dr.name = '{selected_drug}'
-                AND r.activityscore @> dp.activityscore
-                AND r.classification <> 'No Recommendation'
-                AND r.drugrecommendation <> 'No recommendation'
-            ORDER BY p.drugid, r.classification;
-        """
+        # Recommendations for gene symbol, diplotypes, and drug
+        return db.fetch_combinations(selected_gene_symbol, selected_diplotypes, selected_drug)
     elif selected_gene_symbol and selected_diplotypes:
-        # Construct the SQL query for gene symbol and diplotypes without filtering by drug name
-        sql_query = f"""
-            SELECT DISTINCT
-                dp.diplotype,
-                r.activityscore,
-                r.phenotypes,
-                dp.ehrpriority,
-                p.drugid,
-                dr.name,
-                r.population,
-                r.drugrecommendation,
-                r.classification
-            FROM cpic.gene_result_diplotype d
-            JOIN cpic.gene_result_lookup l ON d.functionphenotypeid = l.id
-            JOIN cpic.gene_result gr ON l.phenotypeid = gr.id
-            JOIN cpic.pair p ON gr.genesymbol = p.genesymbol
-            JOIN cpic.drug dr ON p.drugid = dr.drugid
-            JOIN cpic.recommendation r ON dr.drugid = r.drugid
-            JOIN cpic.diplotype_phenotype dp ON r.phenotypes @> dp.phenotype
-            WHERE dp.diplotype ->> '{selected_gene_symbol}' = '{selected_diplotypes}'
-                AND r.activityscore @> dp.activityscore
-                AND r.classification <> 'No Recommendation'
-                AND r.drugrecommendation <> 'No recommendation'
-            ORDER BY p.drugid, r.classification;
-        """
+        # Recommendations for gene symbol and diplotypes without filtering by drug name
+        return db.fetch_combinations(selected_gene_symbol, selected_diplotypes)
     elif selected_drug:
-        sql_query = f"""
-            select distinct d.name,
-	            d.drugid,
-	            r.drugrecommendation,
-	            r.classification,
-	            r.phenotypes
-            from cpic.drug d
-            join cpic.recommendation r on d.drugid = r.drugid
-            where name = '{selected_drug}'
-            AND r.classification <> 'No Recommendation'
-            AND r.drugrecommendation <> 'No recommendation'
-            ORDER BY d.drugid, r.classification;
-        """
-    else:
-        # Handle other cases or provide a default query
-        sql_query = ""
-
-    # Execute the SQL query
-    if sql_query:
-        cur = conn.cursor()
-        cur.execute(sql_query)
-
-        # Fetch the results
-        result = cur.fetchall()
-
-        # Convert the results to a Pandas DataFrame
-        df = pd.DataFrame(result, columns=[desc[0] for desc in cur.description])
-
-        return df
+        return db.fetch_drug_recommendations(selected_drug)
     else:
         return pd.DataFrame()  # Return an empty DataFrame if no query is selected
 
-def main():
+def show_lookup():
     try:
-        cur = conn.cursor()
-
-        # Query to get all unique gene symbols from cpic.gene_result table
-        cur.execute("SELECT DISTINCT genesymbol FROM cpic.gene_result WHERE genesymbol IN ('CYP2C9', 'SLCO1B1', 'CYP2D6', 'TPMT', 'CYP2B6', 'CYP3A5', 'NUDT15', 'UGT1A1', 'CYP2C19')")
-        gene_symbols = ["None"] + sorted([row[0] for row in cur.fetchall()])
+        # Get all unique gene symbols from cpic.gene_result table
+        gene_symbols = db.load_gene_symbols()
 
         # Create the second popover for simplified diplotypes related to the selected gene symbol
         with st.expander("Select Gene Symbol"):
             selected_gene_symbol = gene_col.selectbox("Select Gene Symbol", gene_symbols)
         
-        # Query to get all unique diplotypes for the selected gene symbol from cpic.diplotype_phenotype table
-        cur.execute(f"SELECT DISTINCT diplotype->>'{selected_gene_symbol}' AS simplified_diplotype FROM cpic.diplotype_phenotype WHERE jsonb_exists(diplotype, '{selected_gene_symbol}')")
-        diplotypes = ["None"] + sorted([row[0] for row in cur.fetchall()])
+        # Get all unique diplotypes for the selected gene symbol from cpic.diplotype_phenotype table
+        diplotypes = db.load_diplotypes(selected_gene_symbol)
 
         # Create the second popover for simplified diplotypes related to the selected gene symbol
         with st.expander("Select Diplotypes"):
             selected_diplotypes = diplotype_col.selectbox("Diplotypes", diplotypes)
 
         # Create third dropdown for drugs
-        cur.execute("SELECT DISTINCT name FROM cpic.drug where name IN ('efavirenz','sertraline','trimipramine','lansoprazole','citalopram','clomipramine','escitalopram','doxepin','pantoprazole','imipramine','amitriptyline','omeprazole','dexlansoprazole','fluvastatin','fosphenytoin','phenytoin','celecoxib','lornoxicam','tenoxicam','meloxicam','flurbiprofen','ibuprofen','piroxicam','tamoxifen','tramadol','vortioxetine','codeine','desipramine','paroxetine','atomoxetine','venlafaxine','fluvoxamine','hydrocodone','nortriptyline','tacrolimus','mercaptopurine','thioguanine','azathioprine','atazanavir','atorvastatin','lovastatin','pitavastatin','pravastatin','rosuvastatin','simvastatin','irinotecan','cisplatin') order by name")
-        drugs = ["None"] + sorted([row[0] for row in cur.fetchall()])
+        drugs = db.load_drugs()
 
         # Create the third dropdown for drugs
         with st.expander("Select Drug"):
@@ -183,17 +104,10 @@ def main():
 
             # Check if there are results to add to the HTML report
             if not result_df.empty:
-                # Add the result DataFrame to the HTML report with styling to fit the page
-                html_report = f"<a name='{selected_gene_symbol}_{selected_diplotypes}'></a>\n"
-                html_report += f"<h3>Results for  {selected_gene_symbol}, {selected_diplotypes}</h3>\n"
-                html_report += "<div style='overflow-x:auto;'>\n"
-                html_report += result_df.to_html(index=False, escape=False, classes='report-table', table_id='report-table', justify='center')
-                html_report = html_report.replace('<th>', '<th style="background-color: #ADD8E6; color: black;">')
-                html_report += "\n"
-                html_report += "</div>\n"
-
-                # Display the HTML report
-                st.markdown(html_report, unsafe_allow_html=True)
+                # Display the results as an interactive table
+                st.markdown(f"<a name='{selected_gene_symbol}_{selected_diplotypes}'></a>", unsafe_allow_html=True)
+                st.markdown(f"### Results for  {selected_gene_symbol}, {selected_diplotypes}")
+                show_result_table(result_df)
             
             else:
                 st.warning(f"No results found for Genesymbol: {selected_gene_symbol}, Diplotype: {selected_diplotypes}")
@@ -201,10 +115,6 @@ def main():
     except Exception as e:
         st.error(f"Error: {str(e)}")
 
-    finally:
-        # Close cursor and connection
-        cur.close()
-
     st.write("#")
 
     disclaimer = """
@@ -218,5 +128,13 @@ def main():
 
     st.markdown(disclaimer, unsafe_allow_html=True)
 
+def main():
+    # Warn once when the database was down and cached results were shown instead
+    warning = st.empty()
+    with db.track_fallbacks() as fallbacks:
+        show_lookup()
+    if fallbacks:
+        warning.warning(db.FALLBACK_WARNING)
+
 if __name__ == "__main__":
     main()
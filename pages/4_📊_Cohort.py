@@ -0,0 +1,127 @@
+import streamlit as st
+import altair as alt
+
+import cohort
+import db
+import jobs
+from warmup import warm_up
+
+st.set_page_config(
+    layout="wide",
+    page_title="Cohort",
+    page_icon="📊",
+)
+
+# Check if the database URL is set
+if db.DATABASE_URL is None:
+    st.error("DATABASE_URL environment variable is not set.")
+else:
+    # Preload the caches once per server process. Without the database the page
+    # still shows what it can, its own lookups report the error
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+
+# Custom Streamlit app header
+st.markdown(
+    """
+    <div style='display: flex; background-color: #ADD8E6; padding: 10px; border-radius: 10px;'>
+        <h1 style='margin-right: 20px; color: purple;'>PGxAnalyzer</h1>
+        <img src='https://www.hbku.edu.qa/sites/default/files/media/images/hbku_2021.svg' style='align-self: flex-end; width: 200px; margin-left: auto;'>
+    </div>
+    """,
+    unsafe_allow_html=True
+)
+
+st.write("#")
+st.write('''
+         On this page you can summarize the recommendations of many patients at once. Upload several patient files in the same format as on the **Home Page**, or use all reports stored so far.
+         The table shows for every patient and drug the strongest classification found, and can be downloaded as CSV or Parquet.
+''')
+
+# Patient files of the batch, each one is analyzed as a background job
+uploaded_files = st.file_uploader("Choose .txt files", type="txt", accept_multiple_files=True)
+if 'cohort_jobs' not in st.session_state:
+    st.session_state.cohort_jobs = {}
+for uploaded_file in uploaded_files:
+    if uploaded_file.file_id not in st.session_state.cohort_jobs:
+        st.session_state.cohort_jobs[uploaded_file.file_id] = jobs.submit_job(uploaded_file.getvalue().decode('utf-8'))
+
+source = st.radio("Patients", ["Uploaded files", "All stored reports"], horizontal=True)
+
+@st.fragment(run_every=1)
+def show_batch_progress(job_ids):
+    # Poll the job store until every job of the batch is done
+    done = sum(job["status"] not in ("queued", "running") for job in jobs.job_statuses(job_ids))
+    if done < len(job_ids):
+        st.progress(done / len(job_ids), text=f"Analyzed {done} of {len(job_ids)} patients...")
+    else:
+        st.rerun()
+
+def show_failed_jobs(failed_jobs):
+    # Patients whose analysis failed are missing from the matrix, say which ones and why
+    if failed_jobs:
+        st.error(f"{len(failed_jobs)} of the uploaded patients could not be analyzed and are not included below.")
+        st.dataframe(
+            [{"Patient ID": job["patient_id"], "Error": job["error"]} for job in failed_jobs],
+            hide_index=True,
+            width="stretch",
+        )
+
+def show_cohort(finished_jobs):
+    classifications_df = cohort.classifications_from_jobs(finished_jobs)
+    if classifications_df.empty:
+        st.warning("No recommendations found for these patients.")
+        return
+
+    rank_matrix = cohort.classification_matrix(classifications_df)
+    label_matrix = cohort.label_matrix(rank_matrix)
+    st.write(f"**Patients:** {rank_matrix.shape[0]}, **Drugs:** {rank_matrix.shape[1]}")
+
+    # Drugs with a Strong classification and how many patients they concern
+    st.write("**Patients with a Strong classification per drug:**")
+    st.bar_chart(cohort.strong_patients_per_drug(rank_matrix))
+
+    # Heatmap of the strongest classification of every patient and drug
+    heatmap_df = cohort.heatmap_frame(rank_matrix)
+    alt.data_transformers.disable_max_rows()
+    heatmap = alt.Chart(heatmap_df).mark_rect().encode(
+        x=alt.X("drug:N", title="Drug"),
+        y=alt.Y("patient_id:N", title="Patient ID", axis=alt.Axis(labels=rank_matrix.shape[0] <= 100)),
+        color=alt.Color(
+            "classification:N",
+            scale=alt.Scale(domain=list(cohort.CLASSIFICATION_LABELS), range=["#F0F0F0", "#ADD8E6", "#68BBE3", "#800080"]),
+            title="Classification",
+        ),
+        tooltip=["patient_id", "drug", "classification"],
+    ).properties(height=min(max(12 * rank_matrix.shape[0], 200), 2000))
+    st.altair_chart(heatmap, width="stretch")
+
+    st.dataframe(label_matrix, width="stretch")
+
+    csv_col, parquet_col = st.columns([1, 1])
+    csv_col.download_button(
+        label="Download CSV",
+        data=label_matrix.to_csv(),
+        file_name="cohort_classifications.csv",
+        mime="text/csv",
+    )
+    parquet_col.download_button(
+        label="Download Parquet",
+        data=cohort.to_parquet_bytes(label_matrix),
+        file_name="cohort_classifications.parquet",
+        mime="application/octet-stream",
+    )
+
+if source == "Uploaded files":
+    job_ids = [st.session_state.cohort_jobs[uploaded_file.file_id] for uploaded_file in uploaded_files]
+    if job_ids:
+        batch_jobs = jobs.job_statuses(job_ids)
+        if any(job["status"] in ("queued", "running") for job in batch_jobs):
+            show_batch_progress(job_ids)
+        else:
+            show_failed_jobs([job for job in batch_jobs if job["status"] == "failed"])
+            show_cohort(jobs.latest_reports(job_ids))
+else:
+    show_cohort(jobs.latest_reports())
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+import psycopg2
+import streamlit as st
+
+import db
+import jobs
+import snapshot
+
+# Seconds between two checks for CPIC updates in a running server process
+REFRESH_INTERVAL = int(os.environ.get("PGX_REFRESH_INTERVAL", "3600"))
+
+# Seconds before a failed first read of the change markers is tried again
+REFRESH_RETRY_SECONDS = int(os.environ.get("PGX_REFRESH_RETRY_SECONDS", "60"))
+
+# Statement timeout of the change marker queries in milliseconds, they read whole tables
+REFRESH_TIMEOUT_MS = int(os.environ.get("PGX_REFRESH_TIMEOUT_MS", "30000"))
+
+# Change markers of the last refresh run from the command line
+MARKERS_FILE = os.environ.get("PGX_MARKERS_FILE", "cpic_markers.json")
+
+# Fingerprints of the cpic tables the app reads, grouped by what a change invalidates.
+# They cover every gene, uploaded patient files and stored reports can name any of them
+DIPLOTYPE_MARKERS_QUERY = """
+    SELECT g.genesymbol, dp.diplotype ->> g.genesymbol AS diplotype, md5(string_agg(dp::text, ',' ORDER BY dp::text))
+    FROM cpic.diplotype_phenotype dp
+    CROSS JOIN LATERAL jsonb_object_keys(dp.diplotype) AS g(genesymbol)
+    GROUP BY 1, 2
+"""
+GENE_MARKERS_QUERY = """
+    SELECT gr.genesymbol, md5(string_agg(concat_ws('|', gr.id, l.id, d.id, p.drugid), ',' ORDER BY gr.id, l.id, d.id, p.drugid))
+    FROM cpic.gene_result gr
+    LEFT JOIN cpic.gene_result_lookup l ON l.phenotypeid = gr.id
+    LEFT JOIN cpic.gene_result_diplotype d ON d.functionphenotypeid = l.id
+    LEFT JOIN cpic.pair p ON p.genesymbol = gr.genesymbol
+    GROUP BY 1
+"""
+DRUG_MARKERS_QUERY = """
+    SELECT dr.drugid, dr.name,
+        md5(coalesce(string_agg(r::text, ',' ORDER BY r::text), '')),
+        coalesce(array_agg(DISTINCT k.genesymbol) FILTER (WHERE k.genesymbol IS NOT NULL), '{}')
+    FROM cpic.drug dr
+    LEFT JOIN cpic.recommendation r ON r.drugid = dr.drugid
+    LEFT JOIN LATERAL jsonb_object_keys(r.phenotypes) AS k(genesymbol) ON true
+    GROUP BY 1, 2
+"""
+
+
+def read_markers(query):
+    # query runs one statement and returns its rows as a DataFrame
+    diplotypes = {
+        f"{genesymbol}\t{diplotype}": marker
+        for genesymbol, diplotype, marker in query(DIPLOTYPE_MARKERS_QUERY).itertuples(index=False)
+    }
+    genes = dict(query(GENE_MARKERS_QUERY).itertuples(index=False))
+    drugs = {
+        drugid: [name, marker, sorted(genesymbols)]
+        for drugid, name, marker, genesymbols in query(DRUG_MARKERS_QUERY).itertuples(index=False)
+    }
+    return {"diplotypes": diplotypes, "genes": genes, "drugs": drugs}
+
+
+def query_markers(sql_query):
+    # Through the pool and circuit breaker of the server process, a slow or
+    # unreachable database fails the refresh instead of blocking it
+    return db.run_query(sql_query, timeout_ms=REFRESH_TIMEOUT_MS)
+
+
+def data_version(markers):
+    # One fingerprint over all markers, changes with any CPIC update the app can see
+    return hashlib.md5(json.dumps(markers, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def diff_markers(old, new):
+    def changed_keys(section):
+        return {key for key in old[section].keys() | new[section].keys() if old[section].get(key) != new[section].get(key)}
+
+    changed_diplotypes = {tuple(key.split("\t")) for key in changed_keys("diplotypes")}
+    changed_genes = changed_keys("genes")
+    changed_drugids = changed_keys("drugs")
+
+    # A drug change affects every gene its recommendations refer to, before and after the update
+    drug_genes = set()
+    drug_names = set()
+    for drugid in changed_drugids:
+        for drugs in (old["drugs"], new["drugs"]):
+            if drugid in drugs:
+                name, _, genesymbols = drugs[drugid]
+                drug_names.add(name)
+                drug_genes.update(genesymbols)
+
+    old_diplotypes = {tuple(key.split("\t")) for key in old["diplotypes"]}
+    new_diplotypes = {tuple(key.split("\t")) for key in new["diplotypes"]}
+    return {
+        "diplotypes": changed_diplotypes,
+        "genes": changed_genes | drug_genes,
+        "drugids": changed_drugids,
+        "drug_names": drug_names,
+        # Gene symbols whose diplotype dropdown gained or lost options
+        "diplotype_options": {genesymbol for genesymbol, _ in old_diplotypes ^ new_diplotypes} | changed_genes,
+        "gene_options": old["genes"].keys() & set(db.GENE_SYMBOLS) != new["genes"].keys() & set(db.GENE_SYMBOLS),
+        "drug_options": {drugs[0] for drugs in old["drugs"].values()} != {drugs[0] for drugs in new["drugs"].values()},
+    }
+
+
+def is_affected(changes, genesymbol, diplotype):
+    return genesymbol in changes["genes"] or (genesymbol, diplotype) in changes["diplotypes"]
+
+
+def invalidate_lookups(lookup_cache, changes):
+    # Drop exactly the cached lookups whose rows could have changed
+    def predicate(key):
+        kind = key[0]
+        if kind in ("pair", "combinations"):
+            return is_affected(changes, key[1], key[2])
+        if kind == "drug":
+            return key[1] in changes["drug_names"]
+        if kind == "diplotypes":
+            return key[1] in changes["diplotype_options"]
+        if kind == "genes":
+            return changes["gene_options"]
+        if kind == "drugs":
+            return changes["drug_options"]
+        return False
+
+    return lookup_cache.invalidate(predicate)
+
+
+def has_changes(changes):
+    return any(changes.values())
+
+
+class Refresher:
+    # Keeps the lookup cache of one server process in step with the cpic schema
+
+    def __init__(self, lookup_cache):
+        self.lookup_cache = lookup_cache
+        self.lock = threading.Lock()
+        # Unknown until the first markers are read in the background
+        self.markers = None
+        self.version = None
+
+    def start(self):
+        # Markers the later refreshes compare with
+        with self.lock:
+            started = time.perf_counter()
+            self.markers = read_markers(query_markers)
+            self.version = data_version(self.markers)
+            print(f"CPIC refresh: watching version {self.version}, read in {time.perf_counter() - started:.2f}s")
+
+    def refresh(self):
+        with self.lock:
+            started = time.perf_counter()
+            markers = read_markers(query_markers)
+            checked = time.perf_counter() - started
+
+            changes = diff_markers(self.markers, markers)
+            if not has_changes(changes):
+                print(f"CPIC refresh: no changes, checked in {checked:.2f}s")
+                return changes
+
+            lookups = invalidate_lookups(self.lookup_cache, changes)
+            reports = jobs.invalidate_reports(lambda genesymbol, diplotype: is_affected(changes, genesymbol, diplotype))
+            self.markers = markers
+            self.version = data_version(markers)
+            print(
+                f"CPIC refresh: version {self.version}, {len(changes['genes'])} genes, {len(changes['diplotypes'])} diplotypes, "
+                f"{len(changes['drugids'])} drugs changed; dropped {lookups} cached lookups, marked {reports} reports stale; "
+                f"checked in {checked:.2f}s, total {time.perf_counter() - started:.2f}s"
+            )
+            return changes
+
+    def run(self):
+        while self.markers is None:
+            try:
+                self.start()
+            except Exception as e:
+                print(f"CPIC refresh could not read the current version, trying again in {REFRESH_RETRY_SECONDS}s: {e}")
+                time.sleep(REFRESH_RETRY_SECONDS)
+        while True:
+            time.sleep(REFRESH_INTERVAL)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"CPIC refresh failed: {e}")
+
+
+@st.cache_resource
+def get_refresher():
+    # Started once per server process by the warm-up. Its queries run in its own
+    # thread, so the warm-up and the lookups never wait for them
+    refresher = Refresher(db.get_lookup_cache())
+    threading.Thread(target=refresher.run, name="pgx-cpic-refresh", daemon=True).start()
+    return refresher
+
+
+def current_version():
+    # CPIC data version the lookups of this process are answered from
+    cpic_snapshot = snapshot.get_snapshot()
+    if cpic_snapshot is not None:
+        return "snapshot-{}-{}".format(*cpic_snapshot.file_id)
+    # None until the refresher has read the first markers, the reports made meanwhile are not cached
+    return get_refresher().version
+
+
+def refresh_published():
+    # Command line refresh of what all server processes share: the snapshot and the stored reports
+    started = time.perf_counter()
+    conn = psycopg2.connect(db.DATABASE_URL, options=f"-c statement_timeout={REFRESH_TIMEOUT_MS}", **db.CONNECTION_OPTIONS)
+
+    def query(sql_query):
+        with conn.cursor() as cur:
+            cur.execute(sql_query)
+            return pd.DataFrame(cur.fetchall(), columns=[desc[0] for desc in cur.description])
+
+    try:
+        markers = read_markers(query)
+    finally:
+        conn.close()
+
+    if not os.path.exists(MARKERS_FILE):
+        # First run: nothing to compare with, publish the whole snapshot again if there is one.
+        # Without it the servers query the database, only the markers are recorded
+        if os.path.exists(snapshot.SNAPSHOT_PATH):
+            snapshot.export_snapshot()
+    else:
+        with open(MARKERS_FILE, "r") as file:
+            changes = diff_markers(json.load(file), markers)
+        if not has_changes(changes):
+            print(f"CPIC refresh: no changes, checked in {time.perf_counter() - started:.2f}s")
+            return
+        changed_genes = changes["genes"] | {genesymbol for genesymbol, _ in changes["diplotypes"]}
+        if os.path.exists(snapshot.SNAPSHOT_PATH):
+            snapshot.export_snapshot(changed_genes=changed_genes, changed_drugids=changes["drugids"])
+        reports = jobs.invalidate_reports(lambda genesymbol, diplotype: is_affected(changes, genesymbol, diplotype))
+        print(f"CPIC refresh: {len(changed_genes)} genes and {len(changes['drugids'])} drugs changed, marked {reports} reports stale")
+
+    tmp_path = f"{MARKERS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(markers, file)
+    os.replace(tmp_path, MARKERS_FILE)
+    print(f"CPIC refresh: version {data_version(markers)} in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    # python refresh.py: update the shared snapshot and stale reports after a CPIC update
+    refresh_published()
@@ -0,0 +1,247 @@
+import hashlib
+import io
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+
+import streamlit as st
+
+# Path to the HTML template of the downloadable report
+TEMPLATE_PATH = 'index.html'
+
+# Disclaimer shown below the results and added to the downloadable report
+DISCLAIMER = """
+    <div style='text-align: justify; font-size:10px'>
+    Disclaimer:<br>
+    The recommendations provided in this report are generated based on the available data and algorithms. It is crucial to note that these recommendations should only be considered as supplementary information and not as a substitute for professional medical advice. This report is intended for use by qualified healthcare professionals, and decisions regarding patient care should be made in consultation with a licensed medical practitioner. The information presented here may not encompass all aspects of an individual's medical history or current health condition.<br>
+    The developers and providers of this report disclaim any liability for the accuracy, completeness, or usefulness of the recommendations, and they are not responsible for any adverse consequences resulting from the use of this information.<br>
+    Patients and healthcare providers are encouraged to exercise their professional judgment and consider individual patient characteristics when making medical decisions.
+    </div>
+    """
+
+# Column labels and widths for the interactive result grids
+RESULT_COLUMN_CONFIG = {
+    "diplotype": st.column_config.TextColumn("Diplotype"),
+    "activityscore": st.column_config.TextColumn("Activity Score"),
+    "phenotypes": st.column_config.TextColumn("Phenotypes", width="medium"),
+    "ehrpriority": st.column_config.TextColumn("EHR Priority"),
+    "drugid": st.column_config.TextColumn("Drug ID"),
+    "name": st.column_config.TextColumn("Drug"),
+    "population": st.column_config.TextColumn("Population"),
+    "drugrecommendation": st.column_config.TextColumn("Recommendation", width="large"),
+    "classification": st.column_config.TextColumn("Classification"),
+}
+
+# Number of rendered per-gene report sections kept per server process
+FRAGMENT_CACHE_SIZE = int(os.environ.get("PGX_FRAGMENT_CACHE_SIZE", "5000"))
+
+# Reference to a recommendation text inside a cached report section
+RECOMMENDATION_PLACEHOLDER = re.compile(r"\{\{rec:(\w+)\}\}")
+
+# Columns that describe the gene rather than the drug, written once per gene in the compact report
+SHARED_COLUMNS = ("diplotype", "activityscore", "phenotypes", "ehrpriority", "population")
+
+
+def show_result_table(result_df):
+    # Send the results to the browser as an Arrow table instead of an HTML string
+    st.dataframe(
+        result_df,
+        column_config=RESULT_COLUMN_CONFIG,
+        hide_index=True,
+        width="stretch",
+    )
+
+
+def parse_patient_file(file_contents):
+    # The file starts with the name and id, followed by a header and genesymbol,diplotype lines
+    lines = file_contents.split('\n')
+    name = lines[0].split(':')[-1].strip()
+    user_id = lines[1].split(':')[-1].strip()
+    pairs = [line.split(',') for line in lines[3:]]
+    pairs = [(pair[0].strip(), pair[1].strip()) for pair in pairs if len(pair) == 2]
+    return name, user_id, pairs
+
+
+def flatten_jsonb_columns(result_df):
+    # Process columns with JSONB format to remove {}
+    for col in result_df.columns:
+        if isinstance(result_df[col].iloc[0], dict):
+            result_df[col] = result_df[col].apply(lambda x: ', '.join([f"{k}: {v}" for k, v in x.items()]))
+    return result_df
+
+
+def collect_gene_results(pairs, fetch, on_progress=None):
+    # Query every gene symbol and diplotype of a patient and sort the outcomes
+    gene_results = []
+    genes_with_no_results = []
+    strong_classification_genes = []
+
+    for idx, (genesymbol, diplotype) in enumerate(pairs, start=1):
+        result_df = fetch(genesymbol, diplotype)
+
+        if not result_df.empty:
+            result_df = flatten_jsonb_columns(result_df)
+            gene_results.append((genesymbol, diplotype, result_df))
+
+            # Check if the classification is strong
+            if "Strong" in result_df["classification"].values:
+                strong_classification_genes.append(f"{genesymbol} {diplotype}")
+        else:
+            genes_with_no_results.append(f"{genesymbol}, {diplotype}")
+
+        if on_progress is not None:
+            on_progress(idx)
+
+    return gene_results, genes_with_no_results, strong_classification_genes
+
+
+def build_html_report(name, user_id, timestamp, pairs, gene_results, genes_with_no_results, strong_classification_genes, compact=True, cpic_version=None):
+    # Read the HTML template
+    with open(TEMPLATE_PATH, 'r') as file:
+        html_report = file.read()
+
+    # Replace placeholders with actual values
+    html_report = html_report.replace('{{name}}', name)
+    html_report = html_report.replace('{{user_id}}', user_id)
+    html_report = html_report.replace('{{timestamp}}', timestamp)
+    html_report = html_report.replace('{{disclaimer}}', DISCLAIMER)
+    # Every queried gene symbol and diplotype, also those without results
+    queried_genes_html = "<ul>" + "".join([f"<li>{genesymbol} {diplotype}</li>" for genesymbol, diplotype in pairs]) + "</ul>"
+    no_results_html = "<ul>" + "".join([f"<li>{gene}</li>" for gene in genes_with_no_results]) + "</ul>"
+    strong_classification_html = "<ul>" + "".join([f"<li>{gene}</li>" for gene in strong_classification_genes]) + "</ul>"
+
+    html_report = html_report.replace('{{queried_genes}}', queried_genes_html)
+    html_report = html_report.replace('{{no_results}}', no_results_html)
+    html_report = html_report.replace('{{strong_classification}}', strong_classification_html)
+
+    if compact:
+        html_report += build_compact_gene_sections(gene_results, cpic_version)
+        return html_report
+
+    for genesymbol, diplotype, result_df in gene_results:
+        # Add the result DataFrame to the HTML report
+        html_report += f"""
+<div style="font-size: 20px;">
+    <p><strong>Gene:</strong> {genesymbol}</p>
+    <p><strong>Diplotype:</strong> {diplotype}</p>
+</div>
+"""
+        html_report += result_df.to_html(index=False, escape=False, classes='report-table', table_id=f'report-table-{genesymbol}_{diplotype}', justify='center')
+        html_report = html_report.replace('<th>', '<th style="background-color: #ADD8E6; color: black;">')
+        html_report += "\n"
+
+    return html_report
+
+
+class FragmentCache:
+    # Rendered per-gene report sections shared by every session of the server process,
+    # the least recently used ones are dropped when it is full
+
+    def __init__(self, max_entries):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        fragment = render()
+        with self.lock:
+            self.entries[key] = fragment
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return fragment
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+@st.cache_resource
+def get_fragment_cache():
+    return FragmentCache(FRAGMENT_CACHE_SIZE)
+
+
+def render_gene_section(genesymbol, diplotype, result_df):
+    # Section of one gene symbol and diplotype, recommendation texts are referenced by
+    # placeholders that get their report wide numbers when the report is assembled
+    table_df = result_df.copy()
+
+    # Gene level columns with the same value in every row are shown once above the table
+    shared_columns = [col for col in SHARED_COLUMNS if col in table_df.columns and table_df[col].nunique(dropna=False) == 1]
+    html_section = f"""
+<div class="gene-header">
+    <p><strong>Gene:</strong> {genesymbol}</p>
+    <p><strong>Diplotype:</strong> {diplotype}</p>
+"""
+    for col in shared_columns:
+        html_section += f"    <p><strong>{RESULT_COLUMN_CONFIG[col]['label']}:</strong> {table_df[col].iloc[0]}</p>\n"
+    html_section += "</div>\n"
+
+    recommendations = {}
+    references = []
+    for text in table_df["drugrecommendation"]:
+        key = hashlib.md5(text.encode("utf-8")).hexdigest()[:12]
+        recommendations[key] = text
+        references.append(f'<a href="#rec-{{{{rec:{key}}}}}">R{{{{rec:{key}}}}}</a>')
+    table_df["drugrecommendation"] = references
+
+    html_section += table_df.drop(columns=shared_columns).to_html(index=False, escape=False, border=0, classes='report-table', table_id=f'report-table-{genesymbol}_{diplotype}')
+    html_section += "\n"
+    return html_section, recommendations
+
+
+def build_compact_gene_sections(gene_results, cpic_version):
+    # Each recommendation text is written once at the end and referenced from the tables,
+    # the styling comes from the stylesheet in index.html. The sections only depend on
+    # gene symbol, diplotype and CPIC data, so they come from the fragment cache
+    fragment_cache = get_fragment_cache()
+    recommendation_ids = {}
+    recommendation_texts = {}
+    html_sections = ""
+
+    for genesymbol, diplotype, result_df in gene_results:
+        if cpic_version is None:
+            # Unknown CPIC data version, nothing to key a cached section on
+            html_section, recommendations = render_gene_section(genesymbol, diplotype, result_df)
+        else:
+            html_section, recommendations = fragment_cache.get(
+                (genesymbol, diplotype, cpic_version),
+                lambda: render_gene_section(genesymbol, diplotype, result_df),
+            )
+        html_sections += html_section
+        for key, text in recommendations.items():
+            recommendation_ids.setdefault(key, len(recommendation_ids) + 1)
+            recommendation_texts[key] = text
+
+    html_sections = RECOMMENDATION_PLACEHOLDER.sub(lambda match: str(recommendation_ids[match.group(1)]), html_sections)
+
+    if recommendation_ids:
+        html_sections += "<h3>Recommendations</h3>\n<dl class=\"recommendations\">\n"
+        for key, recommendation_id in recommendation_ids.items():
+            html_sections += f'<dt id="rec-{recommendation_id}">R{recommendation_id}</dt><dd>{recommendation_texts[key]}</dd>\n'
+        html_sections += "</dl>\n"
+
+    return html_sections
+
+
+def zip_report(html_report, file_name="full_report.html"):
+    # Compressed copy of the report for the zip download
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        archive.writestr(file_name, html_report)
+    return buffer.getvalue()
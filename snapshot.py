@@ -0,0 +1,244 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import db
+
+# Arrow file shared read-only by every server process on the host
+SNAPSHOT_PATH = os.environ.get("PGX_SNAPSHOT_PATH", "cpic_snapshot.arrow")
+
+# Columns holding JSONB values, stored as JSON text in the snapshot
+JSON_COLUMNS = ("diplotype", "activityscore", "phenotypes")
+
+SNAPSHOT_COLUMNS = (
+    "kind", "lookup_genesymbol", "lookup_diplotype", "diplotype", "activityscore", "phenotypes",
+    "ehrpriority", "drugid", "name", "population", "drugrecommendation", "classification",
+)
+
+# Every recommendation of every gene symbol and diplotype in diplotype_phenotype, not
+# only the dropdown genes, since uploaded patient files can name any CPIC gene. The
+# p/gr/l/d joins of db.PAIR_QUERY only restrict the drugs so they are a semi-join here
+EXPORT_PAIRS_QUERY = """
+    SELECT DISTINCT
+        g.genesymbol AS lookup_genesymbol,
+        dp.diplotype ->> g.genesymbol AS lookup_diplotype,
+        dp.diplotype::text AS diplotype,
+        r.activityscore::text AS activityscore,
+        r.phenotypes::text AS phenotypes,
+        dp.ehrpriority,
+        dr.drugid,
+        dr.name,
+        r.population,
+        r.drugrecommendation,
+        r.classification
+    FROM cpic.drug dr
+    JOIN cpic.recommendation r ON dr.drugid = r.drugid
+    JOIN cpic.diplotype_phenotype dp ON r.phenotypes @> dp.phenotype
+    CROSS JOIN LATERAL jsonb_object_keys(dp.diplotype) AS g(genesymbol)
+    WHERE dr.drugid IN (
+            SELECT p.drugid
+            FROM cpic.pair p
+            JOIN cpic.gene_result gr ON gr.genesymbol = p.genesymbol
+            JOIN cpic.gene_result_lookup l ON l.phenotypeid = gr.id
+            JOIN cpic.gene_result_diplotype d ON d.functionphenotypeid = l.id
+        )
+        AND r.activityscore @> dp.activityscore
+        AND r.classification <> 'No Recommendation'
+        AND r.drugrecommendation <> 'No recommendation'
+        {filter}
+"""
+
+# Limits an export to the gene symbols and drugs changed by a CPIC refresh
+EXPORT_PAIRS_FILTER = "AND (g.genesymbol = ANY(%(changed_genes)s::text[]) OR dr.drugid = ANY(%(changed_drugids)s::text[]))"
+
+EXPORT_DRUGS_QUERY = """
+    select distinct d.name,
+        d.drugid,
+        r.drugrecommendation,
+        r.classification,
+        r.phenotypes::text AS phenotypes
+    from cpic.drug d
+    join cpic.recommendation r on d.drugid = r.drugid
+    where name IN %(drugs)s
+    AND r.classification <> 'No Recommendation'
+    AND r.drugrecommendation <> 'No recommendation'
+    {filter}
+"""
+
+EXPORT_DRUGS_FILTER = "AND d.drugid = ANY(%(changed_drugids)s::text[])"
+
+# Small row kinds that are always exported in full
+OPTION_KINDS = ("gene", "diplotype", "drug")
+
+
+def export_snapshot(path=SNAPSHOT_PATH, changed_genes=None, changed_drugids=None):
+    # Build the snapshot from the database and publish it atomically. With changed
+    # gene symbols or drugs only their rows are queried again, the rest is kept
+    # from the published snapshot
+    started = time.perf_counter()
+    incremental = (changed_genes is not None or changed_drugids is not None) and os.path.exists(path)
+    changes = {"changed_genes": sorted(changed_genes or ()), "changed_drugids": sorted(changed_drugids or ())}
+    conn = psycopg2.connect(db.DATABASE_URL, **db.CONNECTION_OPTIONS)
+    try:
+        with conn.cursor() as cur:
+            def fetch(sql_query, params=None):
+                cur.execute(sql_query, params)
+                return pd.DataFrame(cur.fetchall(), columns=[desc[0] for desc in cur.description])
+
+            genes = fetch("SELECT DISTINCT genesymbol AS lookup_genesymbol FROM cpic.gene_result WHERE genesymbol IN %(genes)s", {"genes": db.GENE_SYMBOLS})
+            genes["kind"] = "gene"
+            diplotypes = fetch(
+                "SELECT DISTINCT g.genesymbol AS lookup_genesymbol, dp.diplotype ->> g.genesymbol AS lookup_diplotype "
+                "FROM cpic.diplotype_phenotype dp JOIN unnest(%(genes)s::text[]) AS g(genesymbol) ON jsonb_exists(dp.diplotype, g.genesymbol)",
+                {"genes": genes["lookup_genesymbol"].tolist()},
+            )
+            diplotypes["kind"] = "diplotype"
+            drugs = fetch("SELECT DISTINCT name FROM cpic.drug WHERE name IN %(drugs)s", {"drugs": db.DRUG_NAMES})
+            drugs["kind"] = "drug"
+            pairs = fetch(EXPORT_PAIRS_QUERY.format(filter=EXPORT_PAIRS_FILTER if incremental else ""), changes)
+            pairs["kind"] = "pair"
+            drug_recommendations = fetch(
+                EXPORT_DRUGS_QUERY.format(filter=EXPORT_DRUGS_FILTER if incremental else ""),
+                {"drugs": db.DRUG_NAMES, **changes},
+            )
+            drug_recommendations["kind"] = "drug_recommendation"
+    finally:
+        conn.close()
+
+    frames = [genes, diplotypes, drugs, pairs, drug_recommendations]
+    if incremental:
+        kept_df = Snapshot(path).table.to_pandas()
+        replaced = (
+            kept_df["kind"].isin(OPTION_KINDS)
+            | ((kept_df["kind"] == "pair") & (kept_df["lookup_genesymbol"].isin(changes["changed_genes"]) | kept_df["drugid"].isin(changes["changed_drugids"])))
+            | ((kept_df["kind"] == "drug_recommendation") & kept_df["drugid"].isin(changes["changed_drugids"]))
+        )
+        frames.append(kept_df[~replaced])
+
+    snapshot_df = pd.concat(frames, ignore_index=True)
+    snapshot_df = snapshot_df.reindex(columns=SNAPSHOT_COLUMNS).astype(object).where(snapshot_df.notna(), None)
+    snapshot_df = snapshot_df.sort_values(["kind", "lookup_genesymbol", "lookup_diplotype", "drugid", "classification"])
+    table = pa.Table.from_pandas(snapshot_df, schema=pa.schema([(col, pa.string()) for col in SNAPSHOT_COLUMNS]), preserve_index=False)
+
+    # Write next to the published file and rename over it, processes that have the
+    # old file mapped keep reading it until they notice the new one
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+    print(f"Published {'incremental' if incremental else 'full'} CPIC snapshot {path}: {table.num_rows} rows in {time.perf_counter() - started:.2f}s")
+    return table.num_rows
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.file_id = file_id(path)
+        # Zero-copy: the Arrow buffers point straight into the shared page cache
+        self.table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        self.slices = lookup_slices(self.table)
+        # Dropdown options don't change until the next snapshot
+        self.options = {}
+
+    def rows(self, kind, *lookup, **columns):
+        # Rows of a kind, optionally of one gene symbol and diplotype, taken as a slice
+        offset, length = self.slices.get((kind, *lookup), (0, 0))
+        table = self.table.slice(offset, length)
+        for col, value in columns.items():
+            table = table.filter(pc.equal(table[col], value))
+        rows_df = table.to_pandas()
+        for col in JSON_COLUMNS:
+            # Missing values come back as None or NaN depending on the pandas version
+            rows_df[col] = rows_df[col].map(lambda value: json.loads(value) if isinstance(value, str) else None)
+        return rows_df
+
+    def option_list(self, key, load):
+        if key not in self.options:
+            self.options[key] = load()
+        # Callers may modify the list they get
+        return list(self.options[key])
+
+    def gene_symbols(self):
+        return self.option_list(("gene",), lambda: ["None"] + sorted(self.rows("gene")["lookup_genesymbol"].tolist()))
+
+    def diplotypes(self, genesymbol):
+        return self.option_list(
+            ("diplotype", genesymbol),
+            lambda: ["None"] + sorted(self.rows("diplotype", genesymbol)["lookup_diplotype"].tolist()),
+        )
+
+    def drugs(self):
+        return self.option_list(("drug",), lambda: ["None"] + sorted(self.rows("drug")["name"].tolist()))
+
+    def pair_recommendations(self, genesymbol, diplotype, drug=None, include_diplotype=False):
+        filters = {"name": drug} if drug else {}
+        # DISTINCT ON (p.drugid) ... ORDER BY p.drugid, r.classification
+        rows_df = self.rows("pair", genesymbol, diplotype, **filters).drop_duplicates("drugid")
+        columns = ["activityscore", "phenotypes", "ehrpriority", "drugid", "name", "population", "drugrecommendation", "classification"]
+        return rows_df[["diplotype"] + columns if include_diplotype else columns].reset_index(drop=True)
+
+    def combinations(self, genesymbol, diplotype, drug=None):
+        filters = {"name": drug} if drug else {}
+        columns = ["diplotype", "activityscore", "phenotypes", "ehrpriority", "drugid", "name", "population", "drugrecommendation", "classification"]
+        return self.rows("pair", genesymbol, diplotype, **filters)[columns].reset_index(drop=True)
+
+    def drug_recommendations(self, drug):
+        columns = ["name", "drugid", "drugrecommendation", "classification", "phenotypes"]
+        return self.rows("drug_recommendation", name=drug)[columns].reset_index(drop=True)
+
+
+def lookup_slices(table):
+    # The published rows are sorted by kind, gene symbol and diplotype, so the rows of
+    # a kind, of a kind and gene symbol and of a kind, gene symbol and diplotype are
+    # each one contiguous range. Maps each of these keys to (offset, length)
+    key_columns = [
+        table[col].to_numpy().astype(object)
+        for col in ("kind", "lookup_genesymbol", "lookup_diplotype")
+    ]
+    slices = {}
+    changed = np.zeros(max(table.num_rows - 1, 0), dtype=bool)
+    for depth, values in enumerate(key_columns, start=1):
+        # A group of this depth starts where any of its key columns changes
+        changed |= values[1:] != values[:-1]
+        starts = np.concatenate(([0], np.flatnonzero(changed) + 1)) if table.num_rows else np.array([], dtype=int)
+        ends = np.append(starts[1:], table.num_rows)
+        keys = zip(*(column[starts] for column in key_columns[:depth]))
+        for key, start, end in zip(keys, starts.tolist(), ends.tolist()):
+            slices[key] = (start, end - start)
+    return slices
+
+
+def file_id(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot():
+    # The published snapshot, remapped when a new one was swapped in. None if there is none
+    global _snapshot
+    try:
+        current_id = file_id(SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return None
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.file_id != current_id:
+            _snapshot = Snapshot(SNAPSHOT_PATH)
+        return _snapshot
+
+
+if __name__ == "__main__":
+    # Publish a new snapshot: python snapshot.py [path]
+    export_snapshot(sys.argv[1] if len(sys.argv) > 1 else SNAPSHOT_PATH)
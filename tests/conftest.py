@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The app modules live at the top of the repo, the CPIC fixture in benchmarks/
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
@@ -0,0 +1,96 @@
+import json
+
+import pandas as pd
+import pytest
+
+import cohort
+import jobs
+
+
+@pytest.fixture
+def job_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DB", str(tmp_path / "jobs.db"))
+
+
+def add_job(job_id, patient_id, submitted_at, status="finished", classifications=None, results=None):
+    with jobs.connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, patient_id, status, submitted_at, file_contents, results, classifications) VALUES (?, ?, ?, ?, '', ?, ?)",
+            (job_id, patient_id, status, submitted_at, results, json.dumps(classifications) if classifications is not None else None),
+        )
+
+
+def classifications_df(*rows):
+    return pd.DataFrame(rows, columns=["patient_id", "drug", "classification"])
+
+
+def test_classification_matrix_keeps_the_strongest_classification():
+    rank_matrix = cohort.classification_matrix(classifications_df(
+        ("p1", "codeine", "Optional"),
+        ("p1", "codeine", "Strong"),
+        ("p1", "tramadol", "Moderate"),
+        ("p2", "tramadol", None),
+        ("p2", "sertraline", "unknown"),
+    ))
+    assert rank_matrix.dtypes.unique().tolist() == ["int8"]
+    assert rank_matrix.to_dict(orient="index") == {
+        "p1": {"codeine": 3, "sertraline": 0, "tramadol": 2},
+        "p2": {"codeine": 0, "sertraline": 0, "tramadol": 0},
+    }
+    assert cohort.label_matrix(rank_matrix).loc["p1"].tolist() == ["Strong", "None", "Moderate"]
+    assert cohort.strong_patients_per_drug(rank_matrix).to_dict() == {"codeine": 1, "sertraline": 0, "tramadol": 0}
+
+
+def test_classifications_from_jobs():
+    finished_jobs = [
+        {"patient_id": "p1", "classifications": json.dumps([["codeine", "Strong"], ["tramadol", "Optional"]])},
+        {"patient_id": "p2", "classifications": json.dumps([])},
+        {"patient_id": "p3", "classifications": json.dumps([["codeine", "Moderate"]])},
+    ]
+    pd.testing.assert_frame_equal(
+        cohort.classifications_from_jobs(finished_jobs),
+        classifications_df(("p1", "codeine", "Strong"), ("p1", "tramadol", "Optional"), ("p3", "codeine", "Moderate")),
+    )
+    assert cohort.classifications_from_jobs([]).empty
+
+
+def test_latest_reports_ranks_within_the_given_jobs(job_store):
+    add_job("old", "p1", "2026-01-01 10:00:00", classifications=[["codeine", "Optional"]])
+    add_job("batch", "p1", "2026-01-02 10:00:00", classifications=[["codeine", "Strong"]])
+    add_job("newer", "p1", "2026-01-03 10:00:00", classifications=[["codeine", "Moderate"]])
+    add_job("failed", "p1", "2026-01-04 10:00:00", status="failed")
+    add_job("other", "p2", "2026-01-01 10:00:00", status="stale", classifications=[])
+
+    assert sorted(job["id"] for job in jobs.latest_reports()) == ["newer", "other"]
+    # A newer report of the patient outside the batch doesn't hide the batch's report
+    assert [job["id"] for job in jobs.latest_reports(["old", "batch"])] == ["batch"]
+    assert jobs.latest_reports([]) == []
+
+
+def test_latest_reports_backfills_classifications(job_store):
+    result_df = pd.DataFrame({"name": ["codeine", "tramadol"], "classification": ["Strong", "Optional"]})
+    results = {
+        "gene_results": [{"genesymbol": "CYP2D6", "diplotype": "*1/*4", "table": result_df.to_json(orient="split", index=False)}],
+        "no_results": [],
+        "strong_classification": [],
+    }
+    add_job("legacy", "p1", "2026-01-01 10:00:00", results=json.dumps(results))
+
+    [job] = jobs.latest_reports(["legacy"])
+    assert json.loads(job["classifications"]) == [["codeine", "Strong"], ["tramadol", "Optional"]]
+    assert jobs.get_job("legacy")["classifications"] == job["classifications"]
+
+
+def test_job_statuses_of_a_batch(job_store):
+    add_job("done", "p1", "2026-01-01 10:00:00", classifications=[])
+    add_job("broken", "p2", "2026-01-01 10:00:00", status="failed")
+    add_job("outside", "p3", "2026-01-01 10:00:00", status="running")
+    with jobs.connect() as conn:
+        conn.execute("UPDATE jobs SET error = 'Invalid diplotype' WHERE id = 'broken'")
+
+    statuses = sorted(jobs.job_statuses(["done", "broken", "missing"]), key=lambda job: job["id"])
+    assert statuses == [
+        {"id": "broken", "patient_id": "p2", "status": "failed", "error": "Invalid diplotype"},
+        {"id": "done", "patient_id": "p1", "status": "finished", "error": None},
+    ]
+    assert jobs.job_statuses([]) == []
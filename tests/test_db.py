@@ -0,0 +1,182 @@
+import os
+
+import pandas as pd
+import pytest
+
+import db
+
+# A database for the queries that must really run, any postgres will do
+TEST_DB_URL = os.environ.get("PGX_TEST_DB_URL")
+
+
+def loader(value, calls):
+    def load():
+        calls.append(value)
+        return pd.DataFrame({"value": [value]})
+
+    return load
+
+
+def test_lookup_cache_loads_once_and_hands_out_copies():
+    lookup_cache = db.LookupCache(10)
+    calls = []
+    first = lookup_cache.get(("genes",), loader("a", calls))
+    first.loc[0, "value"] = "changed"
+    assert lookup_cache.get(("genes",), loader("b", calls))["value"].tolist() == ["a"]
+    assert calls == ["a"]
+
+
+def test_lookup_cache_drops_the_least_recently_used():
+    lookup_cache = db.LookupCache(2)
+    calls = []
+    lookup_cache.get(("drug", "a"), loader("a", calls))
+    lookup_cache.get(("drug", "b"), loader("b", calls))
+    lookup_cache.get(("drug", "a"), loader("a", calls))
+    lookup_cache.get(("drug", "c"), loader("c", calls))
+    assert list(lookup_cache.entries) == [("drug", "a"), ("drug", "c")]
+    assert list(lookup_cache.last_good) == [("drug", "a"), ("drug", "c")]
+    assert calls == ["a", "b", "c"]
+
+
+def test_lookup_cache_skips_results_loaded_during_an_invalidation():
+    lookup_cache = db.LookupCache(10)
+
+    def load():
+        # The refresh runs while this query is in flight
+        lookup_cache.invalidate(lambda key: True)
+        return pd.DataFrame({"value": ["outdated"]})
+
+    assert lookup_cache.get(("drugs",), load)["value"].tolist() == ["outdated"]
+    assert ("drugs",) not in lookup_cache.entries
+    assert ("drugs",) in lookup_cache.last_good
+
+
+def failing_load():
+    raise db.psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+def test_lookup_cache_falls_back_to_the_last_good_result():
+    lookup_cache = db.LookupCache(10)
+    lookup_cache.get(("drug", "codeine"), loader("a", []))
+    lookup_cache.invalidate(lambda key: True)
+
+    with db.track_fallbacks() as fallbacks:
+        assert lookup_cache.get(("drug", "codeine"), failing_load)["value"].tolist() == ["a"]
+        with pytest.raises(db.psycopg2.OperationalError):
+            lookup_cache.get(("drug", "tramadol"), failing_load)
+    assert fallbacks == [("drug", "codeine")]
+    # The fallback is not cached, the next lookup asks the database again
+    assert ("drug", "codeine") not in lookup_cache.entries
+
+
+def test_nested_fallback_tracking_reports_to_both_blocks():
+    lookup_cache = db.LookupCache(10)
+    lookup_cache.get(("genes",), loader("a", []))
+    lookup_cache.invalidate(lambda key: True)
+    with db.track_fallbacks() as outer:
+        with db.track_fallbacks() as inner:
+            lookup_cache.get(("genes",), failing_load)
+    assert inner == outer == [("genes",)]
+    # Outside a block fallbacks are not recorded anywhere
+    lookup_cache.get(("genes",), failing_load)
+    assert outer == [("genes",)]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(db.time, "monotonic", clock)
+    breaker = db.CircuitBreaker(3, 30, db.QueryStats())
+    breaker.clock = clock
+    return breaker
+
+
+def test_breaker_opens_after_failures_in_a_row(breaker):
+    breaker.before_query()
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.before_query()
+    breaker.record_failure()
+    with pytest.raises(db.DatabaseUnavailable):
+        breaker.before_query()
+    assert breaker.query_stats.stats()["breaker_trips"] == 1
+    assert breaker.query_stats.stats()["rejected"] == 1
+
+
+def open_breaker(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+
+
+def test_breaker_lets_one_trial_through_after_the_reset_time(breaker):
+    open_breaker(breaker)
+    breaker.clock.now += 29
+    with pytest.raises(db.DatabaseUnavailable):
+        breaker.before_query()
+    breaker.clock.now += 1
+    breaker.before_query()
+    # Other queries wait for the outcome of the trial
+    with pytest.raises(db.DatabaseUnavailable):
+        breaker.before_query()
+    breaker.record_success()
+    breaker.before_query()
+    breaker.before_query()
+
+
+def test_failed_trial_opens_the_breaker_again(breaker):
+    open_breaker(breaker)
+    breaker.clock.now += 30
+    breaker.before_query()
+    breaker.record_failure()
+    assert breaker.query_stats.stats()["breaker_trips"] == 2
+    breaker.clock.now += 29
+    with pytest.raises(db.DatabaseUnavailable):
+        breaker.before_query()
+
+
+def test_cancelled_trial_lets_the_next_query_try(breaker):
+    open_breaker(breaker)
+    breaker.clock.now += 30
+    breaker.before_query()
+    breaker.cancel_trial()
+    breaker.before_query()
+    with pytest.raises(db.DatabaseUnavailable):
+        breaker.before_query()
+
+
+@pytest.mark.skipif(TEST_DB_URL is None, reason="PGX_TEST_DB_URL is not set")
+def test_run_query_cancels_slow_queries(monkeypatch):
+    monkeypatch.setattr(db, "DATABASE_URL", TEST_DB_URL)
+    db.get_pool.clear()
+    db.get_circuit_breaker.clear()
+    db.get_query_stats.clear()
+    try:
+        assert db.run_query("SELECT 1 AS one")["one"].tolist() == [1]
+        with pytest.raises(db.errors.QueryCanceled):
+            db.run_query("SELECT pg_sleep(5)", timeout_ms=100)
+        stats = db.get_query_stats().stats()
+        assert stats["queries"] == 2
+        assert stats["timeouts"] == 1
+        assert db.get_circuit_breaker().failures == 1
+        with db.get_cursor() as cur:
+            # The timeout only applied to that transaction, the pooled connection keeps the default
+            cur.execute("SHOW statement_timeout")
+            assert cur.fetchone()[0] == "0"
+            parameters = cur.connection.get_dsn_parameters()
+        assert parameters["keepalives"] == "1"
+        assert parameters["tcp_user_timeout"] == str(db.CONNECTION_OPTIONS["tcp_user_timeout"])
+    finally:
+        db.get_pool.clear()
+        db.get_circuit_breaker.clear()
+        db.get_query_stats.clear()
@@ -0,0 +1,143 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pandas as pd
+import pytest
+
+from conftest import REPO_ROOT
+
+import db
+import jobs
+import refresh
+import report
+
+PATIENT_FILE = "name: Jane\nid: P001\ngenesymbol,diplotype\nCYP2D6,*1/*4\nCYP2C19,*1/*2\nTPMT,*1/*1"
+
+
+def recommendations(genesymbol):
+    return pd.DataFrame({
+        "phenotypes": [{genesymbol: "Intermediate Metabolizer"}] * 2,
+        "name": [f"{genesymbol.lower()}-drug", "codeine"],
+        "drugrecommendation": [f"Adjust the dose for {genesymbol}.", "Use an alternative."],
+        "classification": ["Strong", "Optional"],
+    })
+
+
+@pytest.fixture
+def job_store(tmp_path, monkeypatch):
+    # A fresh job store and worker pool, and no database: the stub below answers the lookups
+    monkeypatch.chdir(REPO_ROOT)
+    monkeypatch.setattr(jobs, "JOBS_DB", str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(refresh, "current_version", lambda: "v1")
+    fragment_cache = report.FragmentCache(100)
+    monkeypatch.setattr(report, "get_fragment_cache", lambda: fragment_cache)
+    jobs.get_executor.clear()
+    jobs.get_db_slots.clear()
+    yield fragment_cache
+    jobs.get_executor().shutdown(wait=True)
+    jobs.get_executor.clear()
+    jobs.get_db_slots.clear()
+
+
+def stub_fetch(monkeypatch, fetch):
+    monkeypatch.setattr(db, "fetch_pair_recommendations", fetch)
+
+
+def wait_for(job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = jobs.get_job(job_id)
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} is still {job['status']}")
+
+
+def test_finished_job_stores_its_report(job_store, monkeypatch):
+    seen = []
+
+    def fetch(genesymbol, diplotype):
+        # What the page polls while the job runs
+        job = jobs.get_job(job_id)
+        seen.append((job["status"], job["progress"]))
+        return recommendations(genesymbol) if genesymbol != "TPMT" else pd.DataFrame()
+
+    stub_fetch(monkeypatch, fetch)
+    job_id = jobs.submit_job(PATIENT_FILE)
+    job = wait_for(job_id)
+
+    assert job["status"] == "finished", job["error"]
+    assert seen == [("running", 0), ("running", 1), ("running", 2)]
+    assert (job["patient_id"], job["name"], job["progress"], job["total"]) == ("P001", "Jane", 3, 3)
+    assert (job["owner_pid"], job["owner_boot"]) == (os.getpid(), jobs.boot_id())
+    assert job["finished_at"] is not None
+    assert job["fallback"] == 0
+
+    gene_results, no_results, strong = jobs.load_results(job)
+    assert [(genesymbol, diplotype) for genesymbol, diplotype, _ in gene_results] == [("CYP2D6", "*1/*4"), ("CYP2C19", "*1/*2")]
+    assert gene_results[0][2]["phenotypes"].tolist() == ["CYP2D6: Intermediate Metabolizer"] * 2
+    assert no_results == ["TPMT, *1/*1"]
+    assert strong == ["CYP2D6 *1/*4", "CYP2C19 *1/*2"]
+    assert json.loads(job["classifications"]) == [
+        ["cyp2d6-drug", "Strong"], ["codeine", "Optional"], ["cyp2c19-drug", "Strong"], ["codeine", "Optional"],
+    ]
+    assert "Adjust the dose for CYP2D6." in job["html_report"]
+    assert report.zip_report(job["html_report"]) == job["report_zip"]
+    # The sections were cached under the CPIC version of the job
+    assert list(job_store.entries) == [("CYP2D6", "*1/*4", "v1"), ("CYP2C19", "*1/*2", "v1")]
+
+
+def test_failed_job_stores_the_error(job_store, monkeypatch):
+    def fetch(genesymbol, diplotype):
+        raise db.DatabaseUnavailable("The database is not responding")
+
+    stub_fetch(monkeypatch, fetch)
+    job = wait_for(jobs.submit_job(PATIENT_FILE))
+    assert job["status"] == "failed"
+    assert job["error"] == "The database is not responding"
+    assert job["finished_at"] is not None
+    assert job["results"] is None
+    assert jobs.find_jobs("P001") == []
+
+
+def test_job_with_fallback_results_skips_the_fragment_cache(job_store, monkeypatch):
+    def fetch(genesymbol, diplotype):
+        db.record_fallback(("pair", genesymbol, diplotype, None, False))
+        return recommendations(genesymbol)
+
+    stub_fetch(monkeypatch, fetch)
+    job = wait_for(jobs.submit_job(PATIENT_FILE))
+    assert job["status"] == "finished", job["error"]
+    assert job["fallback"] == 1
+    assert "Adjust the dose for TPMT." in job["html_report"]
+    assert not job_store.entries
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_jobs_of_gone_server_processes_are_marked_failed(job_store):
+    owners = {
+        "dead": (dead_pid(), jobs.boot_id(), "running"),
+        "rebooted": (os.getpid(), "another-boot", "queued"),
+        "legacy": (None, None, "running"),
+        "alive": (os.getpid(), jobs.boot_id(), "running"),
+        "finished": (dead_pid(), jobs.boot_id(), "finished"),
+    }
+    with jobs.connect() as conn:
+        for job_id, (owner_pid, owner_boot, status) in owners.items():
+            conn.execute(
+                "INSERT INTO jobs (id, status, submitted_at, file_contents, owner_pid, owner_boot) VALUES (?, ?, '2026-01-01', '', ?, ?)",
+                (job_id, status, owner_pid, owner_boot),
+            )
+
+    jobs.get_executor()
+    statuses = {job_id: jobs.get_job(job_id)["status"] for job_id in owners}
+    assert statuses == {"dead": "failed", "rebooted": "failed", "legacy": "failed", "alive": "running", "finished": "finished"}
+    assert jobs.get_job("dead")["error"] == "Interrupted by a server restart"
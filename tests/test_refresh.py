@@ -0,0 +1,194 @@
+import copy
+import os
+import threading
+import time
+
+import pytest
+
+import db
+import refresh
+from loadtest import FIXTURE_DRUGS, load_cpic_fixture
+
+# The fixture replaces the cpic schema, so only a throwaway database will do
+TEST_DB_URL = os.environ.get("PGX_TEST_DB_URL")
+
+MARKERS = {
+    "diplotypes": {"CYP2C19\t*1/*1": "a", "CYP2C19\t*1/*2": "b", "DPYD\t*1/*1": "c"},
+    "genes": {"CYP2C19": "d", "DPYD": "e"},
+    "drugs": {"RxNorm:32968": ["clopidogrel", "f", ["CYP2C19"]], "RxNorm:4492": ["fluorouracil", "g", ["DPYD"]]},
+}
+
+LOOKUP_KEYS = [
+    ("genes",),
+    ("drugs",),
+    ("diplotypes", "CYP2C19"),
+    ("diplotypes", "CYP2D6"),
+    ("pair", "CYP2C19", "*1/*1", None, False),
+    ("pair", "CYP2C19", "*1/*2", None, False),
+    ("combinations", "CYP2D6", "*1/*1"),
+    ("drug", "clopidogrel"),
+    ("drug", "codeine"),
+]
+
+
+def changed(**sections):
+    new = copy.deepcopy(MARKERS)
+    for section, values in sections.items():
+        new[section].update(values)
+    return refresh.diff_markers(MARKERS, new)
+
+
+def filled_cache():
+    lookup_cache = db.LookupCache(100)
+    for key in LOOKUP_KEYS:
+        lookup_cache.get(key, lambda: db.pd.DataFrame({"key": [str(key)]}))
+    return lookup_cache
+
+
+def test_unchanged_markers_have_no_changes():
+    assert not refresh.has_changes(refresh.diff_markers(MARKERS, copy.deepcopy(MARKERS)))
+
+
+def test_changed_diplotype_affects_only_that_pair():
+    changes = changed(diplotypes={"CYP2C19\t*1/*2": "x"})
+    assert changes["diplotypes"] == {("CYP2C19", "*1/*2")}
+    assert changes["genes"] == set()
+    assert refresh.is_affected(changes, "CYP2C19", "*1/*2")
+    assert not refresh.is_affected(changes, "CYP2C19", "*1/*1")
+
+
+def test_genes_outside_the_dropdowns_are_fingerprinted():
+    # Uploaded files and stored reports can name genes the dropdowns don't offer
+    assert "DPYD" not in db.GENE_SYMBOLS
+    changes = changed(diplotypes={"DPYD\t*1/*2": "x"}, genes={"DPYD": "y"})
+    assert changes["diplotypes"] == {("DPYD", "*1/*2")}
+    assert changes["genes"] == {"DPYD"}
+    assert changes["diplotype_options"] == {"DPYD"}
+    assert not changes["gene_options"]
+
+
+def test_changed_drug_affects_its_genes_before_and_after():
+    changes = changed(drugs={"RxNorm:32968": ["clopidogrel", "x", ["CYP2C9"]]})
+    assert changes["drugids"] == {"RxNorm:32968"}
+    assert changes["drug_names"] == {"clopidogrel"}
+    assert changes["genes"] == {"CYP2C19", "CYP2C9"}
+    assert not changes["drug_options"]
+
+
+def test_new_drug_changes_the_drug_options():
+    assert changed(drugs={"RxNorm:2670": ["codeine", "x", ["CYP2D6"]]})["drug_options"]
+
+
+def test_invalidate_drops_exactly_the_affected_lookups():
+    lookup_cache = filled_cache()
+    changes = changed(diplotypes={"CYP2C19\t*1/*2": "x"}, drugs={"RxNorm:32968": ["clopidogrel", "x", ["CYP2C19"]]})
+    assert refresh.invalidate_lookups(lookup_cache, changes) == 3
+    assert list(lookup_cache.entries) == [
+        ("genes",),
+        ("drugs",),
+        ("diplotypes", "CYP2C19"),
+        ("diplotypes", "CYP2D6"),
+        ("combinations", "CYP2D6", "*1/*1"),
+        ("drug", "codeine"),
+    ]
+
+
+def test_invalidate_drops_changed_dropdowns():
+    lookup_cache = filled_cache()
+    changes = changed(diplotypes={"CYP2C19\t*2/*2": "x"}, genes={"CYP2D6": "y"})
+    refresh.invalidate_lookups(lookup_cache, changes)
+    assert ("diplotypes", "CYP2C19") not in lookup_cache.entries
+    assert ("genes",) not in lookup_cache.entries
+    assert ("drugs",) in lookup_cache.entries
+
+
+def test_refresher_reads_the_first_markers_in_the_background(monkeypatch):
+    reads = []
+
+    def read_markers(query):
+        # The database is down on the first try
+        reads.append(query)
+        if len(reads) == 1:
+            raise db.DatabaseUnavailable("The database is not responding")
+        return MARKERS
+
+    monkeypatch.setattr(refresh, "read_markers", read_markers)
+    monkeypatch.setattr(refresh, "REFRESH_RETRY_SECONDS", 0)
+    monkeypatch.setattr(refresh, "REFRESH_INTERVAL", 3600)
+
+    # Creating it queries nothing, the warm-up doesn't wait for it
+    refresher = refresh.Refresher(db.LookupCache(10))
+    assert reads == []
+    assert refresher.version is None
+
+    threading.Thread(target=refresher.run, daemon=True).start()
+    deadline = time.time() + 10
+    while refresher.version is None and time.time() < deadline:
+        time.sleep(0.01)
+    assert refresher.version == refresh.data_version(MARKERS)
+    assert len(reads) == 2
+
+
+@pytest.fixture(scope="module")
+def cpic_database():
+    if TEST_DB_URL is None:
+        pytest.skip("PGX_TEST_DB_URL is not set")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(db, "DATABASE_URL", TEST_DB_URL)
+        load_cpic_fixture(TEST_DB_URL)
+        yield
+        db.get_pool.clear()
+
+
+@pytest.fixture
+def query_stats(cpic_database):
+    db.get_circuit_breaker.clear()
+    db.get_query_stats.clear()
+    yield db.get_query_stats()
+    db.get_circuit_breaker.clear()
+    db.get_query_stats.clear()
+
+
+def test_refresher_reads_markers_through_run_query(query_stats):
+    refresher = refresh.Refresher(db.LookupCache(10))
+    refresher.start()
+    assert set(refresher.markers["genes"]) == set(FIXTURE_DRUGS)
+    assert {key.split("\t")[0] for key in refresher.markers["diplotypes"]} == set(FIXTURE_DRUGS)
+    assert not refresh.has_changes(refresher.refresh())
+    assert query_stats.stats()["queries"] == 6
+
+
+def test_refresh_gives_up_on_a_slow_database(query_stats, monkeypatch):
+    refresher = refresh.Refresher(db.LookupCache(10))
+    refresher.start()
+    markers = refresher.markers
+    monkeypatch.setattr(refresh, "REFRESH_TIMEOUT_MS", 100)
+    monkeypatch.setattr(refresh, "DIPLOTYPE_MARKERS_QUERY", "SELECT 'CYP2D6', '*1/*1', md5('') FROM pg_sleep(5)")
+    with pytest.raises(db.errors.QueryCanceled):
+        refresher.refresh()
+    assert refresher.markers is markers
+    assert query_stats.stats()["timeouts"] == 1
+
+
+@pytest.fixture
+def published(cpic_database, tmp_path, monkeypatch):
+    exports = []
+    monkeypatch.setattr(refresh, "MARKERS_FILE", str(tmp_path / "cpic_markers.json"))
+    monkeypatch.setattr(refresh.snapshot, "SNAPSHOT_PATH", str(tmp_path / "cpic_snapshot.arrow"))
+    monkeypatch.setattr(refresh.snapshot, "export_snapshot", lambda **changes: exports.append(changes))
+    return exports
+
+
+def test_first_published_refresh_without_a_snapshot_only_records_markers(published):
+    # A deployment that queries the database must not switch to a snapshot nobody asked for
+    refresh.refresh_published()
+    assert published == []
+    assert os.path.exists(refresh.MARKERS_FILE)
+
+
+def test_first_published_refresh_republishes_an_existing_snapshot(published):
+    open(refresh.snapshot.SNAPSHOT_PATH, "w").close()
+    refresh.refresh_published()
+    assert published == [{}]
+    refresh.refresh_published()
+    assert published == [{}]
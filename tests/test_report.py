@@ -0,0 +1,64 @@
+import re
+
+import pandas as pd
+import pytest
+
+import report
+
+
+def results(*recommendations):
+    return pd.DataFrame({
+        "phenotypes": ["Normal Metabolizer"] * len(recommendations),
+        "name": [f"drug{i}" for i in range(len(recommendations))],
+        "drugrecommendation": list(recommendations),
+        "classification": ["Strong"] * len(recommendations),
+    })
+
+
+@pytest.fixture
+def fragment_cache(monkeypatch):
+    fragment_cache = report.FragmentCache(100)
+    monkeypatch.setattr(report, "get_fragment_cache", lambda: fragment_cache)
+    return fragment_cache
+
+
+def references(html_sections):
+    return re.findall(r'<a href="#rec-(\d+)">R(\d+)</a>', html_sections)
+
+
+def test_recommendations_are_numbered_once_per_report(fragment_cache):
+    gene_results = [
+        ("CYP2C19", "*1/*2", results("Use an alternative.", "Initiate therapy.")),
+        ("CYP2D6", "*1/*1", results("Initiate therapy.", "Avoid use.")),
+    ]
+    html_sections = report.build_compact_gene_sections(gene_results, None)
+    assert references(html_sections) == [("1", "1"), ("2", "2"), ("2", "2"), ("3", "3")]
+    assert re.findall(r'<dt id="rec-(\d+)">R\d+</dt><dd>([^<]*)</dd>', html_sections) == [
+        ("1", "Use an alternative."),
+        ("2", "Initiate therapy."),
+        ("3", "Avoid use."),
+    ]
+    assert "{{rec:" not in html_sections
+
+
+def test_cached_sections_are_numbered_per_report(fragment_cache):
+    cyp2c19 = ("CYP2C19", "*1/*2", results("Use an alternative.", "Initiate therapy."))
+    cyp2d6 = ("CYP2D6", "*1/*1", results("Initiate therapy.", "Avoid use."))
+
+    first = report.build_compact_gene_sections([cyp2c19, cyp2d6], "v1")
+    assert first == report.build_compact_gene_sections([cyp2c19, cyp2d6], None)
+
+    # The cached CYP2D6 section starts the numbering of a report it comes first in
+    second = report.build_compact_gene_sections([cyp2d6], "v1")
+    assert second == report.build_compact_gene_sections([cyp2d6], None)
+    assert references(second) == [("1", "1"), ("2", "2")]
+    assert fragment_cache.stats()["hits"] == 1
+    assert fragment_cache.stats()["misses"] == 2
+
+
+def test_sections_are_cached_per_cpic_version(fragment_cache):
+    gene_results = [("CYP2C19", "*1/*2", results("Use an alternative."))]
+    report.build_compact_gene_sections(gene_results, "v1")
+    report.build_compact_gene_sections(gene_results, "v2")
+    report.build_compact_gene_sections(gene_results, None)
+    assert list(fragment_cache.entries) == [("CYP2C19", "*1/*2", "v1"), ("CYP2C19", "*1/*2", "v2")]
@@ -0,0 +1,74 @@
+import os
+
+import pandas as pd
+import pytest
+
+import db
+import snapshot
+from loadtest import FIXTURE_DRUGS, fixture_diplotypes, load_cpic_fixture
+
+# The fixture replaces the cpic schema, so only a throwaway database will do
+TEST_DB_URL = os.environ.get("PGX_TEST_DB_URL")
+
+pytestmark = pytest.mark.skipif(TEST_DB_URL is None, reason="PGX_TEST_DB_URL is not set")
+
+
+@pytest.fixture(scope="module")
+def cpic_snapshot(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(db, "DATABASE_URL", TEST_DB_URL)
+        load_cpic_fixture(TEST_DB_URL)
+        db.get_pool.clear()
+        db.get_lookup_cache.clear()
+        path = str(tmp_path_factory.mktemp("snapshot") / "cpic_snapshot.arrow")
+        snapshot.export_snapshot(path)
+        yield snapshot.Snapshot(path)
+        db.get_pool.clear()
+        db.get_lookup_cache.clear()
+
+
+def assert_same_rows(snapshot_df, db_df):
+    # The queries only order by drug and classification, compare the rows in a fixed order
+    assert list(snapshot_df.columns) == list(db_df.columns)
+
+    def normalized(result_df):
+        return result_df.astype(str).sort_values(list(result_df.columns)).reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(normalized(snapshot_df), normalized(db_df))
+
+
+def all_pairs():
+    return [(genesymbol, diplotype) for genesymbol in FIXTURE_DRUGS for diplotype, _, _ in fixture_diplotypes(genesymbol)]
+
+
+def test_options_match_the_database(cpic_snapshot):
+    assert cpic_snapshot.gene_symbols() == db.query_gene_symbols()
+    assert cpic_snapshot.drugs() == db.query_drugs()
+    for genesymbol in cpic_snapshot.gene_symbols()[1:]:
+        assert cpic_snapshot.diplotypes(genesymbol) == db.query_diplotypes(genesymbol)
+
+
+@pytest.mark.parametrize("genesymbol, diplotype", all_pairs())
+def test_pair_recommendations_match_the_database(cpic_snapshot, genesymbol, diplotype):
+    db_df = db.query_pair_recommendations(genesymbol, diplotype)
+    assert not db_df.empty
+    assert_same_rows(cpic_snapshot.pair_recommendations(genesymbol, diplotype), db_df)
+    assert_same_rows(
+        cpic_snapshot.pair_recommendations(genesymbol, diplotype, include_diplotype=True),
+        db.query_pair_recommendations(genesymbol, diplotype, include_diplotype=True),
+    )
+    drug = FIXTURE_DRUGS[genesymbol][0]
+    assert_same_rows(
+        cpic_snapshot.pair_recommendations(genesymbol, diplotype, drug),
+        db.query_pair_recommendations(genesymbol, diplotype, drug),
+    )
+
+
+@pytest.mark.parametrize("genesymbol, diplotype", all_pairs())
+def test_combinations_match_the_database(cpic_snapshot, genesymbol, diplotype):
+    assert_same_rows(cpic_snapshot.combinations(genesymbol, diplotype), db.query_combinations(genesymbol, diplotype))
+
+
+@pytest.mark.parametrize("drug", sorted({drug for drugs in FIXTURE_DRUGS.values() for drug in drugs} & set(db.DRUG_NAMES)))
+def test_drug_recommendations_match_the_database(cpic_snapshot, drug):
+    assert_same_rows(cpic_snapshot.drug_recommendations(drug), db.query_drug_recommendations(drug))
@@ -0,0 +1,125 @@
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import streamlit as st
+from streamlit import runtime
+from streamlit.web import cli as stcli
+
+import db
+import refresh
+import snapshot
+
+# File written once the caches of a server process are hot, one per server port
+READY_FILE = os.environ.get("PGX_READY_FILE", ".warmup_ready.{port}.json")
+
+# Sample file whose gene symbols and diplotypes are preloaded
+SAMPLE_FILE = "sample data/input_values.txt"
+
+
+def read_sample_pairs(file_path=SAMPLE_FILE):
+    # The sample file has name, id and a header line before the genesymbol,diplotype pairs
+    with open(file_path, "r") as file:
+        lines = file.read().split('\n')
+    pairs = [line.split(',') for line in lines[3:]]
+    return [(pair[0].strip(), pair[1].strip()) for pair in pairs if len(pair) == 2]
+
+
+@st.cache_resource(show_spinner="Warming up PGxAnalyzer...")
+def warm_up():
+    # Runs once per server process, every later session finds the caches hot
+    started = time.perf_counter()
+
+    # Preload the dropdown options
+    gene_symbols = db.load_gene_symbols()
+    for genesymbol in gene_symbols[1:]:
+        db.load_diplotypes(genesymbol)
+    drugs = db.load_drugs()
+
+    # Preload the CPIC recommendations for every drug in the dropdown
+    for drug in drugs[1:]:
+        db.fetch_drug_recommendations(drug)
+
+    # Preload the recommendations used by the sample file on the Hello and Home pages
+    sample_pairs = read_sample_pairs()
+    for genesymbol, diplotype in sample_pairs:
+        db.fetch_pair_recommendations(genesymbol, diplotype, include_diplotype=True)
+        db.fetch_pair_recommendations(genesymbol, diplotype)
+
+    # Watch the cpic schema for updates, the snapshot publisher does that when there is one
+    if snapshot.get_snapshot() is None:
+        refresh.get_refresher()
+
+    elapsed = time.perf_counter() - started
+    status = {
+        "pid": os.getpid(),
+        "port": st.get_option("server.port"),
+        "finished_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "elapsed_seconds": round(elapsed, 3),
+        "gene_symbols": len(gene_symbols) - 1,
+        "drugs": len(drugs) - 1,
+        "sample_pairs": len(sample_pairs),
+        "snapshot": snapshot.get_snapshot() is not None,
+    }
+    print(f"Warm-up finished in {elapsed:.2f}s: {status}")
+
+    # Write the readiness file atomically so a reader never sees half of it
+    file_path = ready_file(status["port"])
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(status, file)
+    os.replace(tmp_path, file_path)
+
+    return status
+
+
+def ready_file(port):
+    return READY_FILE.format(port=port)
+
+
+def is_ready(port):
+    # Ready only if the readiness file of the port was written by a server process that is still running
+    try:
+        with open(ready_file(port), "r") as file:
+            status = json.load(file)
+        os.kill(status["pid"], 0)
+    except (OSError, ValueError, KeyError):
+        return False
+    return True
+
+
+def warm_up_on_start():
+    # The runtime exists once the server has loaded its config, the port included
+    while not runtime.exists():
+        time.sleep(0.1)
+    try:
+        warm_up()
+    except Exception as e:
+        # The first page load tries again
+        print(f"Warm-up failed: {e}")
+
+
+def serve(streamlit_args):
+    # Start the server and warm it up right away, so the first visitor finds the caches hot
+    if db.DATABASE_URL is not None:
+        threading.Thread(target=warm_up_on_start, name="pgx-warm-up", daemon=True).start()
+    sys.argv = ["streamlit", "run", *streamlit_args]
+    sys.exit(stcli.main())
+
+
+if __name__ == "__main__":
+    # Import the module by its name, so the server and the pages share one warm_up cache
+    import warmup
+
+    if sys.argv[1:2] == ["serve"]:
+        # python warmup.py serve app.py [streamlit options]: start command of the server
+        warmup.serve(sys.argv[2:])
+    else:
+        # python warmup.py [port]: exits with 0 once the caches of that server are hot, 1 otherwise
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else st.get_option("server.port")
+        ready = warmup.is_ready(port)
+        print("ready" if ready else "not ready")
+        sys.exit(0 if ready else 1)